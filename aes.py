@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 # (c) 2011, Cumulus Python <cumulus.python@gmail.com>. No rights reserved.
-# Optimized version of pure Python AES.
+# Optimized version of pure Python AES using T-tables of 32-bit words.
 
 '''
 To check the time it takes for 1 iteration of encryption plus decryption of 1000 bytes of data using AES 128 bit key:
@@ -9,30 +9,30 @@ To check the time it takes for 1 iteration of encryption plus decryption of 1000
 To print the time taken by individual functions over 200 iterations:
   $ python -m cProfile aes.py
 
+To measure the rate of encryption and decryption of 1181 bytes RTMFP packets:
+  $ python -c "import aes; aes._test(dataSize=1181, repeat=1000, bench=True)"
+
 Performance Measurement
 -----------------------
   $ python -m timeit "import aes; aes._test(repeat=1);"
-  10 loops, best of 3: 29.5 msec per loop
+  100 loops, best of 3: 2.91 msec per loop
 '''
 
-import os, sys, math, struct, random
+import os, sys, math, struct, random, time
 
 OFB, CFB, CBC = 0, 1, 2 # mode of operation
 SIZE_128, SIZE_192, SIZE_256 = 16, 24, 32
 
-iv_null   = lambda: [0 for i in xrange(16)]
-iv_random = lambda: [ord(random.randint(0, 255)) for i in xrange(16)]
+iv_null   = lambda: '\x00'*16
+iv_random = lambda: os.urandom(16)
 
-def encrypt(key, data, iv, mode=CBC):
-    key, keysize = map(ord, key), len(key)
-    assert keysize in (16, 24, 32), 'invalid key size: %s' % keysize
-    (mode, length, ciph) = _encrypt(data, mode, key, keysize, iv) # do not store the length
-    return ''.join(map(chr, ciph))
+def encrypt(key, data, iv, mode=CBC): # the data is padded with zeros to a multiple of 16 bytes in CBC mode
+    assert len(key) in (16, 24, 32), 'invalid key size: %s' % len(key)
+    return _encrypt(data, mode, key, iv if isinstance(iv, str) else ''.join(map(chr, iv)))
 
 def decrypt(key, data, iv, mode=CBC):
-    key, data, keysize = map(ord, key), map(ord, data), len(key)
-    assert keysize in (16, 24, 32), 'invalid key size: %s' % keysize
-    return _decrypt(data, None, mode, key, keysize, iv)
+    assert len(key) in (16, 24, 32), 'invalid key size: %s' % len(key)
+    return _decrypt(data, mode, key, iv if isinstance(iv, str) else ''.join(map(chr, iv)))
 
 def append_PKCS7_padding(s): # return s padded to a multiple of 16-bytes by PKCS7 padding
     numpads = 16 - (len(s)%16)
@@ -63,160 +63,147 @@ _sbox  = map(ord, '\x63\x7c\x77\x7b\xf2\x6b\x6f\xc5\x30\x01\x67\x2b\xfe\xd7\xab\
 _rsbox = map(ord, '\x52\x09\x6a\xd5\x30\x36\xa5\x38\xbf\x40\xa3\x9e\x81\xf3\xd7\xfb\x7c\xe3\x39\x82\x9b\x2f\xff\x87\x34\x8e\x43\x44\xc4\xde\xe9\xcb\x54\x7b\x94\x32\xa6\xc2\x23\x3d\xee\x4c\x95\x0b\x42\xfa\xc3\x4e\x08\x2e\xa1\x66\x28\xd9\x24\xb2\x76\x5b\xa2\x49\x6d\x8b\xd1\x25\x72\xf8\xf6\x64\x86\x68\x98\x16\xd4\xa4\x5c\xcc\x5d\x65\xb6\x92\x6c\x70\x48\x50\xfd\xed\xb9\xda\x5e\x15\x46\x57\xa7\x8d\x9d\x84\x90\xd8\xab\x00\x8c\xbc\xd3\x0a\xf7\xe4\x58\x05\xb8\xb3\x45\x06\xd0\x2c\x1e\x8f\xca\x3f\x0f\x02\xc1\xaf\xbd\x03\x01\x13\x8a\x6b\x3a\x91\x11\x41\x4f\x67\xdc\xea\x97\xf2\xcf\xce\xf0\xb4\xe6\x73\x96\xac\x74\x22\xe7\xad\x35\x85\xe2\xf9\x37\xe8\x1c\x75\xdf\x6e\x47\xf1\x1a\x71\x1d\x29\xc5\x89\x6f\xb7\x62\x0e\xaa\x18\xbe\x1b\xfc\x56\x3e\x4b\xc6\xd2\x79\x20\x9a\xdb\xc0\xfe\x78\xcd\x5a\xf4\x1f\xdd\xa8\x33\x88\x07\xc7\x31\xb1\x12\x10\x59\x27\x80\xec\x5f\x60\x51\x7f\xa9\x19\xb5\x4a\x0d\x2d\xe5\x7a\x9f\x93\xc9\x9c\xef\xa0\xe0\x3b\x4d\xae\x2a\xf5\xb0\xc8\xeb\xbb\x3c\x83\x53\x99\x61\x17\x2b\x04\x7e\xba\x77\xd6\x26\xe1\x69\x14\x63\x55\x21\x0c\x7d')
 _rcon  = map(ord, '\x8d\x01\x02\x04\x08\x10\x20\x40\x80\x1b\x36\x6c\xd8\xab\x4d\x9a\x2f\x5e\xbc\x63\xc6\x97\x35\x6a\xd4\xb3\x7d\xfa\xef\xc5\x91\x39\x72\xe4\xd3\xbd\x61\xc2\x9f\x25\x4a\x94\x33\x66\xcc\x83\x1d\x3a\x74\xe8\xcb\x8d\x01\x02\x04\x08\x10\x20\x40\x80\x1b\x36\x6c\xd8\xab\x4d\x9a\x2f\x5e\xbc\x63\xc6\x97\x35\x6a\xd4\xb3\x7d\xfa\xef\xc5\x91\x39\x72\xe4\xd3\xbd\x61\xc2\x9f\x25\x4a\x94\x33\x66\xcc\x83\x1d\x3a\x74\xe8\xcb\x8d\x01\x02\x04\x08\x10\x20\x40\x80\x1b\x36\x6c\xd8\xab\x4d\x9a\x2f\x5e\xbc\x63\xc6\x97\x35\x6a\xd4\xb3\x7d\xfa\xef\xc5\x91\x39\x72\xe4\xd3\xbd\x61\xc2\x9f\x25\x4a\x94\x33\x66\xcc\x83\x1d\x3a\x74\xe8\xcb\x8d\x01\x02\x04\x08\x10\x20\x40\x80\x1b\x36\x6c\xd8\xab\x4d\x9a\x2f\x5e\xbc\x63\xc6\x97\x35\x6a\xd4\xb3\x7d\xfa\xef\xc5\x91\x39\x72\xe4\xd3\xbd\x61\xc2\x9f\x25\x4a\x94\x33\x66\xcc\x83\x1d\x3a\x74\xe8\xcb\x8d\x01\x02\x04\x08\x10\x20\x40\x80\x1b\x36\x6c\xd8\xab\x4d\x9a\x2f\x5e\xbc\x63\xc6\x97\x35\x6a\xd4\xb3\x7d\xfa\xef\xc5\x91\x39\x72\xe4\xd3\xbd\x61\xc2\x9f\x25\x4a\x94\x33\x66\xcc\x83\x1d\x3a\x74\xe8\xcb')
 
-
-def _core(word, iteration): # core key schedule: rotate 32-bit word 8 bits to left, apply S-box on all 4 parts and XOR the rcon output with first part
-    word = word[1:] + word[:1]
-    for i in xrange(4): word[i] = _sbox[word[i]]
-    word[0] = word[0] ^ _rcon[iteration]
-    return word
-
-def _expandKey(key, size, expandedKeySize): # Rijndael's key expansion: expands an 128,192,256 key into an 176,208,240 bytes key
-    currentSize, rconIteration = 0, 1
-    expandedKey = [0]*expandedKeySize
-    for j in xrange(size): expandedKey[j] = key[j] # set the 16, 24, 32 bytes of the expanded key to the input key
-    currentSize += size
-    while currentSize < expandedKeySize:
-        t = expandedKey[currentSize-4:currentSize] # assign the previous 4 bytes to the temporary value t
-        if currentSize % size == 0: # every 16,24,32 bytes we apply the core schedule to t and increment rconIteration afterwards
-            t = _core(t, rconIteration)
-            rconIteration += 1
-        if size == SIZE_256 and ((currentSize % size) == 16): # For 256-bit keys, we add an extra sbox to the calculation
-            for l in xrange(4): t[l] = _sbox[t[l]]
-        for m in xrange(4): # We XOR t with the four-byte block 16,24,32 bytes before the new expanded key.  This becomes the next four bytes in the expanded key.
-            expandedKey[currentSize] = expandedKey[currentSize - size] ^  t[m]
-            currentSize += 1
-    return expandedKey
-
-def _addRoundKey(state, roundKey): # Adds (XORs) the round key to the state.
-    for i in xrange(16): state[i] ^= roundKey[i]
-    return state
-
-def _createRoundKey(expanded, pos): # create a round key from the given expanded key and the position within
-    subset = expanded[pos:pos+16]
-    return [subset[0], subset[4], subset[8], subset[12],
-            subset[1], subset[5], subset[9], subset[13],
-            subset[2], subset[6], subset[10],subset[14],
-            subset[3], subset[7], subset[11],subset[15]]
-
-def _subBytes(state, isInv): # substitute all values from S-Box or inverted S-box
-    return [_rsbox[x] for x in state] if isInv else [_sbox[x] for x in state]
-
-def _shiftRows(state, isInv): # shift row all rows by row index
-    if isInv:
-        state[4], state[5], state[6], state[7] = state[7], state[4], state[5], state[6]
-        state[8], state[9], state[10],state[11]= state[10],state[11],state[8], state[9]
-        state[12],state[13],state[14],state[15]= state[13],state[14],state[15],state[12]
-    else:
-        state[4], state[5], state[6], state[7] = state[5], state[6], state[7], state[4]
-        state[8], state[9], state[10],state[11]= state[10],state[11],state[8], state[9]
-        state[12],state[13],state[14],state[15]= state[15],state[12],state[13],state[14]
-    return state
-
-_mixColumnInv = lambda c0, c1, c2, c3: (_g14[c0] ^ _g9[c3] ^ _g13[c2] ^ _g11[c1], _g14[c1] ^ _g9[c0] ^ _g13[c3] ^ _g11[c2], _g14[c2] ^ _g9[c1] ^ _g13[c0] ^ _g11[c3], _g14[c3] ^ _g9[c2] ^ _g13[c1] ^ _g11[c0])
-_mixColumn = lambda c0, c1, c2, c3: (_g2[c0] ^ _g1[c3] ^ _g1[c2] ^ _g3[c1], _g2[c1] ^ _g1[c0] ^ _g1[c3] ^ _g3[c2], _g2[c2] ^ _g1[c1] ^ _g1[c0] ^ _g3[c3], _g2[c3] ^ _g1[c2] ^ _g1[c1] ^ _g3[c0])
-    
-def _mixColumns(state, isInv): # galois multiplication of 4x4 matrix
-    state[0], state[4], state[8], state[12] = (_mixColumnInv if isInv else _mixColumn)(state[0], state[4], state[8], state[12])
-    state[1], state[5], state[9], state[13] = (_mixColumnInv if isInv else _mixColumn)(state[1], state[5], state[9], state[13])
-    state[2], state[6], state[10],state[14] = (_mixColumnInv if isInv else _mixColumn)(state[2], state[6], state[10],state[14])
-    state[3], state[7], state[11],state[15] = (_mixColumnInv if isInv else _mixColumn)(state[3], state[7], state[11],state[15])
-    return state
-
-def _aes_round(state, roundKey): # forward round operations
-    return _addRoundKey(_mixColumns(_shiftRows(_subBytes(state, False), False), False), roundKey)
-
-def _aes_invRound(state, roundKey): # inverse round operations
-    return _mixColumns(_addRoundKey(_subBytes(_shiftRows(state, True), True), roundKey), True)
-
-def _aes_main(state, expandedKey, nbrRounds): # initial operations, standard round, and final operations of forward direction
-    state = _addRoundKey(state, _createRoundKey(expandedKey, 0))
-    for i in xrange(1, nbrRounds):
-        state = _addRoundKey(_mixColumns(_shiftRows(_subBytes(state, False), False), False), _createRoundKey(expandedKey, 16*i))
-    return _addRoundKey(_shiftRows(_subBytes(state, False), False), _createRoundKey(expandedKey, 16*nbrRounds))
-
-def _aes_invMain(state, expandedKey, nbrRounds): # initial operations, standard round, and final operations of inverse direction
-    state = _addRoundKey(state, _createRoundKey(expandedKey, 16*nbrRounds))
-    for i in xrange(nbrRounds-1, 0, -1):
-        state = _mixColumns(_addRoundKey(_subBytes(_shiftRows(state, True), True), _createRoundKey(expandedKey, 16*i)), True)
-    return _addRoundKey(_subBytes(_shiftRows(state, True), True), _createRoundKey(expandedKey, 0))
-
-_last_key = _last_expanded_key = None
+# T-tables that combine SubBytes, ShiftRows and MixColumns of a round into four lookups per 32-bit column word. _te0[x] is
+# the column (2s, s, s, 3s) for s = _sbox[x] and _td0[x] is (14r, 9r, 13r, 11r) for r = _rsbox[x], and the others are byte
+# rotations of these. _s0.._s3 and _rs0.._rs3 are the S-box values shifted to each byte position for the last round.
+_te0 = [(_g2[s] << 24) | (s << 16) | (s << 8) | _g3[s] for s in _sbox]
+_td0 = [(_g14[r] << 24) | (_g9[r] << 16) | (_g13[r] << 8) | _g11[r] for r in _rsbox]
+_te1, _te2, _te3 = [[(w >> n) | ((w << (32-n)) & 0xffffffff) for w in _te0] for n in (8, 16, 24)]
+_td1, _td2, _td3 = [[(w >> n) | ((w << (32-n)) & 0xffffffff) for w in _td0] for n in (8, 16, 24)]
+_s0, _s1, _s2, _s3 = [[s << n for s in _sbox] for n in (24, 16, 8, 0)]
+_rs0, _rs1, _rs2, _rs3 = [[r << n for r in _rsbox] for n in (24, 16, 8, 0)]
 
 _rounds = {SIZE_128: 10, SIZE_192: 12, SIZE_256: 14}
 
-def _aes_block(iput, key, size, isInv): # encrypt 128-bit input block against the given key of given size
-    global _last_key, _last_expanded_key, _rounds
-    if size not in _rounds: return None
-    nbrRounds = _rounds.get(size)
-    expandedKeySize = 16*(nbrRounds+1) # the expanded keySize
-
-    block = [iput[i+4*j] for i in xrange(4) for j in xrange(4)]
-    expandedKey = _last_expanded_key if _last_key == key else _expandKey(key, size, expandedKeySize) # expand the key into an 176, 208, 240 bytes key the expanded key
-    _last_key, _last_expanded_key = key, expandedKey
-    
-    block = _aes_invMain(block, expandedKey, nbrRounds) if isInv else _aes_main(block, expandedKey, nbrRounds)  # encrypt or decrypt the block using the expandedKey
-    return [block[i+4*j] for i in xrange(4) for j in xrange(4)]
-
-def _encrypt(stringIn, mode, key, size, IV):
-    assert len(key) % size == 0 and len(IV) % 16 == 0
-    cipherOut, firstRound = [], True
-    if stringIn != None:
-        for start in xrange(0, len(stringIn), 16):
-            plaintext = map(ord, stringIn[start:start+16])
-            if len(plaintext) < 16: plaintext += [0]*(16-len(plaintext))
-            if mode == CFB:
-                output = _aes_block(IV if firstRound else iput, key, size, False)
-                firstRound = False
-                # TODO: verify the following
-                ciphertext = [(0 if len(plaintext)-1 < i else plaintext[0]) ^ (0 if len(output)-1 < i else output[i]) for i in xrange(16)]
-                cipherOut += [ciphertext[k] for k in xrange(end-start)]
-                iput = ciphertext if mode == CFB else output
-            elif mode == CBC:
-                iput = [plaintext[i] ^ IV[i] for i in xrange(16)] if firstRound else [plaintext[i] ^ ciphertext[i] for i in xrange(16)]
-                firstRound = False
-                ciphertext = _aes_block(iput, key, size, False)
-                cipherOut += ciphertext
-    return mode, len(stringIn), cipherOut
-
-def _decrypt(cipherIn, originalsize, mode, key, size, IV):
-    assert len(key) % size == 0 and len(IV) % 16 == 0
-    stringOut, firstRound = [], True
-    if cipherIn != None:
-        for start in xrange(0, len(cipherIn), 16):
-            ciphertext = cipherIn[start:start+16]
-            end = start + len(ciphertext)
-            if mode == CFB or mode == OFB:
-                output = _aes_block(IV if firstRound else iput, key, size, False) # TODO: verify that it calls encrypt, and not decrypt
-                firstRound = False
-                # TODO: verify the following
-                plaintext = [(0 if len(output)-1 < i else output[0]) ^ (0 if len(ciphertext)-1 < i else ciphertext[i]) for i in xrange(16)]
-                stringOut += [plaintext[k] for k in xrange(end-start)]
-                iput = ciphertext if mode == CFB else output
-            elif mode == CBC:
-                output = _aes_block(ciphertext, key, size, True)
-                plaintext = [IV[i] ^ output[i] for i in xrange(16)] if firstRound else [iput[i] ^ output[i] for i in xrange(16)]
-                firstRound = False
-                end1 = originalsize if originalsize is not None and originalsize < end else end
-                stringOut += [plaintext[k] for k in xrange(end1-start)]
-                iput = ciphertext
-    return ''.join(map(chr, stringOut))
-
-def _test(debug=False, mode=CBC, dataSize=1000, keySize=16, repeat=100):
+def _expandKey(key): # Rijndael's key expansion of 16, 24, 32 bytes key into (rounds, encrypt round key words, decrypt round key words)
+    nk, rounds = len(key) / 4, _rounds[len(key)]
+    w = list(struct.unpack('>%dI'%(nk,), key))
+    for i in xrange(nk, 4*(rounds+1)):
+        t = w[i-1]
+        if i % nk == 0: # rotate word 8 bits to left, apply S-box on all 4 bytes and XOR the rcon with the first byte
+            t = (_s0[(t >> 16) & 0xff] | _s1[(t >> 8) & 0xff] | _s2[t & 0xff] | _s3[t >> 24]) ^ (_rcon[i/nk] << 24)
+        elif nk > 6 and i % nk == 4: # for 256-bit keys we add an extra S-box to the calculation
+            t = _s0[t >> 24] | _s1[(t >> 16) & 0xff] | _s2[(t >> 8) & 0xff] | _s3[t & 0xff]
+        w.append(w[i-nk] ^ t)
+    # the equivalent inverse cipher uses the round keys in reverse order with InvMixColumns applied to the inner ones
+    d = []
+    for r in xrange(rounds, -1, -1):
+        for t in w[4*r:4*r+4]:
+            d.append(t if r in (0, rounds) else _td0[_sbox[t >> 24]] ^ _td1[_sbox[(t >> 16) & 0xff]] ^ _td2[_sbox[(t >> 8) & 0xff]] ^ _td3[_sbox[t & 0xff]])
+    return rounds, w, d
+
+_keys = {} # cache of expanded keys indexed by the key, so that each session key is expanded only once
+
+def _schedule(key): # return the cached expanded key for the given key
+    try: return _keys[key]
+    except KeyError:
+        if len(_keys) >= 1024: _keys.clear() # do not grow without bound as sessions come and go
+        result = _keys[key] = _expandKey(key)
+        return result
+
+def _encryptBlock(s0, s1, s2, s3, rk, rounds, te0=_te0, te1=_te1, te2=_te2, te3=_te3, s0_=_s0, s1_=_s1, s2_=_s2, s3_=_s3): # encrypt one block of four words
+    s0, s1, s2, s3 = s0 ^ rk[0], s1 ^ rk[1], s2 ^ rk[2], s3 ^ rk[3]
+    for k in xrange(4, 4*rounds, 4):
+        s0, s1, s2, s3 = (te0[s0 >> 24] ^ te1[(s1 >> 16) & 0xff] ^ te2[(s2 >> 8) & 0xff] ^ te3[s3 & 0xff] ^ rk[k],
+                          te0[s1 >> 24] ^ te1[(s2 >> 16) & 0xff] ^ te2[(s3 >> 8) & 0xff] ^ te3[s0 & 0xff] ^ rk[k+1],
+                          te0[s2 >> 24] ^ te1[(s3 >> 16) & 0xff] ^ te2[(s0 >> 8) & 0xff] ^ te3[s1 & 0xff] ^ rk[k+2],
+                          te0[s3 >> 24] ^ te1[(s0 >> 16) & 0xff] ^ te2[(s1 >> 8) & 0xff] ^ te3[s2 & 0xff] ^ rk[k+3])
+    k = 4*rounds # last round has no MixColumns
+    return (s0_[s0 >> 24] ^ s1_[(s1 >> 16) & 0xff] ^ s2_[(s2 >> 8) & 0xff] ^ s3_[s3 & 0xff] ^ rk[k],
+            s0_[s1 >> 24] ^ s1_[(s2 >> 16) & 0xff] ^ s2_[(s3 >> 8) & 0xff] ^ s3_[s0 & 0xff] ^ rk[k+1],
+            s0_[s2 >> 24] ^ s1_[(s3 >> 16) & 0xff] ^ s2_[(s0 >> 8) & 0xff] ^ s3_[s1 & 0xff] ^ rk[k+2],
+            s0_[s3 >> 24] ^ s1_[(s0 >> 16) & 0xff] ^ s2_[(s1 >> 8) & 0xff] ^ s3_[s2 & 0xff] ^ rk[k+3])
+
+def _decryptBlock(s0, s1, s2, s3, rk, rounds, td0=_td0, td1=_td1, td2=_td2, td3=_td3, s0_=_rs0, s1_=_rs1, s2_=_rs2, s3_=_rs3): # decrypt one block of four words
+    s0, s1, s2, s3 = s0 ^ rk[0], s1 ^ rk[1], s2 ^ rk[2], s3 ^ rk[3]
+    for k in xrange(4, 4*rounds, 4):
+        s0, s1, s2, s3 = (td0[s0 >> 24] ^ td1[(s3 >> 16) & 0xff] ^ td2[(s2 >> 8) & 0xff] ^ td3[s1 & 0xff] ^ rk[k],
+                          td0[s1 >> 24] ^ td1[(s0 >> 16) & 0xff] ^ td2[(s3 >> 8) & 0xff] ^ td3[s2 & 0xff] ^ rk[k+1],
+                          td0[s2 >> 24] ^ td1[(s1 >> 16) & 0xff] ^ td2[(s0 >> 8) & 0xff] ^ td3[s3 & 0xff] ^ rk[k+2],
+                          td0[s3 >> 24] ^ td1[(s2 >> 16) & 0xff] ^ td2[(s1 >> 8) & 0xff] ^ td3[s0 & 0xff] ^ rk[k+3])
+    k = 4*rounds # last round has no InvMixColumns
+    return (s0_[s0 >> 24] ^ s1_[(s3 >> 16) & 0xff] ^ s2_[(s2 >> 8) & 0xff] ^ s3_[s1 & 0xff] ^ rk[k],
+            s0_[s1 >> 24] ^ s1_[(s0 >> 16) & 0xff] ^ s2_[(s3 >> 8) & 0xff] ^ s3_[s2 & 0xff] ^ rk[k+1],
+            s0_[s2 >> 24] ^ s1_[(s1 >> 16) & 0xff] ^ s2_[(s0 >> 8) & 0xff] ^ s3_[s3 & 0xff] ^ rk[k+2],
+            s0_[s3 >> 24] ^ s1_[(s2 >> 16) & 0xff] ^ s2_[(s1 >> 8) & 0xff] ^ s3_[s0 & 0xff] ^ rk[k+3])
+
+def _words(data): # return the big-endian 32-bit words of data, zero padded to a multiple of 16 bytes
+    if len(data) % 16: data += '\x00'*(16 - len(data) % 16)
+    return struct.unpack('>%dI'%(len(data)/4,), data)
+
+def _encrypt(data, mode, key, iv):
+    rounds, rk, dk = _schedule(key)
+    words, out, block = _words(data), [], _encryptBlock
+    c0, c1, c2, c3 = _words(iv)
+    for i in xrange(0, len(words), 4):
+        p0, p1, p2, p3 = words[i:i+4]
+        if mode == CBC: c0, c1, c2, c3 = block(p0 ^ c0, p1 ^ c1, p2 ^ c2, p3 ^ c3, rk, rounds)
+        else:
+            o0, o1, o2, o3 = block(c0, c1, c2, c3, rk, rounds)
+            c0, c1, c2, c3 = p0 ^ o0, p1 ^ o1, p2 ^ o2, p3 ^ o3
+            out += (c0, c1, c2, c3)
+            if mode == OFB: c0, c1, c2, c3 = o0, o1, o2, o3
+            continue
+        out += (c0, c1, c2, c3)
+    result = struct.pack('>%dI'%(len(out),), *out)
+    return result if mode == CBC else result[:len(data)] # the stream modes do not pad
+
+def _decrypt(data, mode, key, iv):
+    if mode != CBC: # the stream modes decrypt by encrypting the same key stream, except that CFB feeds back the cipher text
+        if mode == OFB: return _encrypt(data, mode, key, iv)
+        rounds, rk, dk = _schedule(key)
+        words, out, block = _words(data), [], _encryptBlock
+        c0, c1, c2, c3 = _words(iv)
+        for i in xrange(0, len(words), 4):
+            o0, o1, o2, o3 = block(c0, c1, c2, c3, rk, rounds)
+            c0, c1, c2, c3 = words[i:i+4]
+            out += (c0 ^ o0, c1 ^ o1, c2 ^ o2, c3 ^ o3)
+        return struct.pack('>%dI'%(len(out),), *out)[:len(data)]
+    rounds, rk, dk = _schedule(key)
+    words, out, block = _words(data), [], _decryptBlock
+    c0, c1, c2, c3 = _words(iv)
+    for i in xrange(0, len(words), 4):
+        p0, p1, p2, p3 = block(words[i], words[i+1], words[i+2], words[i+3], dk, rounds)
+        out += (p0 ^ c0, p1 ^ c1, p2 ^ c2, p3 ^ c3)
+        c0, c1, c2, c3 = words[i:i+4]
+    return struct.pack('>%dI'%(len(out),), *out)
+
+def _test(debug=False, mode=CBC, dataSize=1000, keySize=16, repeat=100, bench=False):
+    # with bench, use one key as in an RTMFP session, and print the rate of encryption and decryption in MB/s and packets/s
     cleartext = ''.join([chr(random.randint(0, 255)) for i in xrange(dataSize)])
     if debug: print 'cleartext=%r'%(cleartext,)
+    cypherkey, elapsed = ''.join([chr(random.randint(1,255)) for i in xrange(keySize)]), [0, 0]
     for i in xrange(repeat):
-        cypherkey, iv = [random.randint(1,255) for i in xrange(keySize)], [0 for i in xrange(keySize)]
-        mode1, orig_len, ciph = _encrypt(cleartext, mode, cypherkey, keySize, iv)
-        if debug: print 'mode=%s, original length=%s (%s)\nencrypted=%s'%(mode, orig_len, len(cleartext), ciph)
-        decr = _decrypt(ciph, orig_len, mode1, cypherkey, keySize, iv)
+        if not bench: cypherkey = ''.join([chr(random.randint(1,255)) for i in xrange(keySize)])
+        iv, start = iv_null(), time.time()
+        ciph = encrypt(cypherkey, cleartext, iv, mode)
+        elapsed[0] += time.time() - start
+        if debug: print 'mode=%s, original length=%s\nencrypted=%r'%(mode, len(cleartext), ciph)
+        start = time.time()
+        decr = decrypt(cypherkey, ciph, iv, mode)[:len(cleartext)] # CBC pads with zeros
+        elapsed[1] += time.time() - start
         if debug: print 'decrypted=%r'%(decr,)
         assert decr == cleartext
+    if bench:
+        for name, value in zip(('encrypt', 'decrypt'), elapsed):
+            print '%s %d packets of %d bytes in %.3f s: %.2f MB/s, %d packets/s'%(name, repeat, dataSize, value, repeat*dataSize/value/1e6, repeat/value)
 
 def _test2():
     encoded = "%\x01\xf6o\xfd\x00\xb7\x9a\xd8\x01A\xf5\xae\xeb\x91y\x15\x8d\x19@\x9d\x83\x05\xef'\x16\x86|v4~j\x8ejT'\x9f\x97d\xd6\x19\xd5\xfa\xd5C\xeb\xd2g\xfb\xd9 \xc0\x86l\xe6^\x94\x05<\xa0\xe6\xbc\xa1\xbd\xea\x8c\xfe\xd8"
     decr = decrypt('Adobe Systems 02', encoded[4:], iv=iv_null())
     assert decr.find('rtmfp://localhost/myapp') >= 0
 
+def _test3(): # known answer tests of FIPS-197 appendix C
+    plain = ''.join(map(chr, xrange(0, 256, 17)))
+    for key, expected in (('000102030405060708090a0b0c0d0e0f', '69c4e0d86a7b0430d8cdb78070b4c55a'),
+                          ('000102030405060708090a0b0c0d0e0f1011121314151617', 'dda97ca4864cdfe06eaf70a0ec0d7191'),
+                          ('000102030405060708090a0b0c0d0e0f101112131415161718191a1b1c1d1e1f', '8ea2b7ca516745bfeafc49904b496089')):
+        key = key.decode('hex')
+        assert encrypt(key, plain, iv_null()).encode('hex') == expected
+        assert decrypt(key, expected.decode('hex'), iv_null()) == plain
+
 if __name__ == "__main__":
     _test()
     _test2()
+    _test3()
+    _test(dataSize=1181, repeat=1000, bench=True)
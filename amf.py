@@ -21,11 +21,30 @@ class _Undefined(object):
 
 undefined = _Undefined()  # received undefined is different from null (None)
 
+_u16, _s16, _u32, _double = struct.Struct('!H'), struct.Struct('!h'), struct.Struct('!L'), struct.Struct('!d') # for decoding at an offset
+
+def _ref(refs, index):
+    try: return refs[index]
+    except IndexError: raise ValueError('invalid reference index')
+
+class _References(list): # a reference table with an index for find(), where strings are found by value and others by identity
+    def __init__(self): list.__init__(self); self._index, self._indexed = {}, 0
+    def find(self, data): # return the index of data or None. The items appended since the last find are indexed first.
+        index = self._index
+        for i in xrange(self._indexed, len(self)):
+            item = self[i]; key = item if isinstance(item, basestring) else id(item)
+            if key not in index: index[key] = i
+        self._indexed = len(self)
+        return index.get(data if isinstance(data, basestring) else id(data))
+
 
 class BytesIO(StringIO): # raise EOFError if needed, allow read with optional length, and peek next byte
     def __init__(self, *args, **kwargs): StringIO.__init__(self, *args, **kwargs)
     def eof(self): return self.tell() >= self.len  # return true if next read will cause EOFError
     def remaining(self): return self.len - self.tell() # return number of remaining bytes
+    def getbuffer(self): # return (buf, pos) where buf[pos:] are the remaining bytes, to decode in place and then seek past them
+        if self.buflist: self.buf += ''.join(self.buflist); self.buflist = [] # as done by StringIO.read
+        return self.buf, self.pos
     
     def read(self, length=-1):
         if length > 0 and self.eof(): raise EOFError # raise error if reading beyond EOF
@@ -58,12 +77,10 @@ class BytesIO(StringIO): # raise EOFError if needed, allow read with optional le
         return result
     def write_u29(self, c):
         if c < 0 or c > 0x1fffffff: raise ValueError('uint29 out of range')
-        bytes = ''
-        if c >= 0x200000: bytes += chr(0x80 | ((c >> 22) & 0x7f))
-        if c >= 0x4000: bytes += chr(0x80 | ((c >> 15) & 0x7f))
-        if c >= 0x80: bytes += chr(0x80 | ((c >> 8) & 0x7f))
-        if c >= 0x200000: bytes += chr(c & 0xff)
-        else: bytes += chr(c & 0x7f)
+        if c < 0x80: bytes = chr(c)
+        elif c < 0x4000: bytes = chr(0x80 | (c >> 7)) + chr(c & 0x7f)
+        elif c < 0x200000: bytes = chr(0x80 | (c >> 14)) + chr(0x80 | ((c >> 7) & 0x7f)) + chr(c & 0x7f)
+        else: bytes = chr(0x80 | (c >> 22)) + chr(0x80 | ((c >> 15) & 0x7f)) + chr(0x80 | ((c >> 8) & 0x7f)) + chr(c & 0xff)
         self.write(bytes)
     def write_s29(self, c):
         if c < -0x10000000 or c > 0x0fffffff: raise ValueError('sint29 out of range')
@@ -75,30 +92,16 @@ class AMF0(object):
     NUMBER, BOOL, STRING, OBJECT, MOVIECLIP, NULL, UNDEFINED, REFERENCE, ECMA_ARRAY, OBJECT_END, ARRAY, DATE, LONG_STRING, UNSUPPORTED, RECORDSET, XML, TYPED_OBJECT, TYPE_AMF3 = range(0x12)
 
     def __init__(self, data=None):
-        self._obj_refs, self.data = list(), data if isinstance(data, BytesIO) else BytesIO(data) if data is not None else BytesIO()
+        self._obj_refs, self.data = _References(), data if isinstance(data, BytesIO) else BytesIO(data) if data is not None else BytesIO()
     def _created(self, obj): # new object-reference is created
         self._obj_refs.append(obj); return obj
-    def read(self):
-        global undefined
-        marker = self.data.read_u8()
-        if   marker == AMF0.NUMBER:   return self.data.read_double()
-        elif marker == AMF0.BOOL:     return bool(self.data.read_u8())
-        elif marker == AMF0.STRING:   return self.readString()
-        elif marker == AMF0.OBJECT:   return self.readObject()
-        elif marker == AMF0.MOVIECLIP:raise NotImplementedError()
-        elif marker == AMF0.NULL:     return None
-        elif marker == AMF0.UNDEFINED:return undefined
-        elif marker == AMF0.REFERENCE:return self.readReference()
-        elif marker == AMF0.ECMA_ARRAY:return self.readEcmaArray()
-        elif marker == AMF0.ARRAY:    return self.readArray() 
-        elif marker == AMF0.DATE:     return self.readDate()
-        elif marker == AMF0.LONG_STRING:return self.readLongString()
-        elif marker == AMF0.UNSUPPORTED:return None
-        elif marker == AMF0.RECORDSET:raise NotImplementedError()
-        elif marker == AMF0.XML:      return self.readXML()
-        elif marker == AMF0.TYPED_OBJECT: return self.readTypedObject()
-        elif marker == AMF0.TYPE_AMF3: return AMF3(self.data).read()
-        else: raise ValueError('Invalid AMF0 marker 0x%02x at %d' % (marker, self.data.tell()-1))
+    def read(self): # decode the next value at the current position of data, and move the position past it.
+        return _read(self, self.data)
+    def decode(self, buf, pos): # decode the value in str or buffer at offset pos, and return (value, offset after it).
+        marker = ord(buf[pos])
+        decoder = AMF0._decoders[marker] if marker < len(AMF0._decoders) else None
+        if decoder is None: raise ValueError('Invalid AMF0 marker 0x%02x at %d' % (marker, pos))
+        return decoder(self, buf, pos+1)
         
     def write(self, data):
         global undefined
@@ -111,10 +114,13 @@ class AMF0(object):
         elif isinstance(data, (datetime.date, datetime.datetime)): self.writeDate(data)
         elif isinstance(data, ET._ElementInterface): self.writeXML(data)
         elif isinstance(data, types.DictType):     self.writeEcmaArray(data)
+        elif isinstance(data, Slot):               self.writeSlot(data)
         elif isinstance(data, Object) and hasattr(data, '_classname'): self.writeTypedObject(data)
         elif isinstance(data, (Object, object)):   self.writeObject(data)
         else: raise ValueError('Invalid AMF0 data %r type %r' % (data, type(data)))
 
+    def writeSlot(self, data): raise ValueError('amf.Slot %r is allowed only in a Template' % (data.name,)) # see _TemplateWriter
+
     def readString(self): return self.data.read_utf8(self.data.read_u16())
     def readLongString(self): return self.data.read_utf8(self.data.read_u32())
     def writeString(self, data, writeType=True):
@@ -141,7 +147,8 @@ class AMF0(object):
         try: return self._obj_refs[self.data.read_u16()]
         except IndexError: raise ValueError('invalid reference index')
     def writePossibleReference(self, data):
-        if data in self._obj_refs: self.data.write_u8(AMF0.REFERENCE); self.data.write_u16(self._obj_refs.index(data)); return True
+        index = self._obj_refs.find(data)
+        if index is not None: self.data.write_u8(AMF0.REFERENCE); self.data.write_u16(index); return True
         elif len(self._obj_refs) < 0xfffe: self._obj_refs.append(data)
     
     def readEcmaArray(self):
@@ -166,8 +173,9 @@ class AMF0(object):
             self.data.write_u8(AMF0.ARRAY); self.data.write_u32(len(data))
             for val in data: self.write(val)
     
-    def readDate(self):
-        ms, tz = self.data.read_double(), self.data.read_s16()
+    def readDate(self): return AMF0._date(self.data.read_double(), self.data.read_s16())
+    @staticmethod
+    def _date(ms, tz):
         class TZ(datetime.tzinfo):
             def utcoffset(self, dt): return datetime.timedelta(minutes=tz)
             def dst(self,dt): return None
@@ -189,37 +197,71 @@ class AMF0(object):
     def writeTypedObject(self, data):
         if not self.writePossibleReference(data):
             self.data.write_u8(AMF0.TYPED_OBJECT)
-            self.data.writeString(data._classname)
+            self.writeString(data._classname, False)
             for key, val in data.__dict__.items(): 
                 if not key.startswith('_'): self.writeString(key, False); self.write(val)
             self.writeString('', False); self.data.write_u8(AMF0.OBJECT_END)
 
+    # decoders of decode(), each takes the offset after the marker and returns (value, offset after the value)
+    def _decodeNumber(self, buf, pos): return _double.unpack_from(buf, pos)[0], pos+8
+    def _decodeBool(self, buf, pos): return buf[pos] != '\x00', pos+1
+    def _decodeString(self, buf, pos):
+        end = pos + 2 + _u16.unpack_from(buf, pos)[0]
+        if end > len(buf): raise EOFError
+        return unicode(buf[pos+2:end], 'utf8'), end
+    def _decodeLongString(self, buf, pos):
+        end = pos + 4 + _u32.unpack_from(buf, pos)[0]
+        if end > len(buf): raise EOFError
+        return unicode(buf[pos+4:end], 'utf8'), end
+    def _decodeObject(self, buf, pos, obj=None):
+        if obj is None: obj = self._created(Object())
+        decodeString, decode, end = self._decodeString, self.decode, chr(AMF0.OBJECT_END)
+        while True:
+            key, pos = decodeString(buf, pos)
+            if key == '' and buf[pos] == end: return obj, pos+1
+            value, pos = decode(buf, pos); setattr(obj, key, value)
+    def _decodeNotImplemented(self, buf, pos): raise NotImplementedError()
+    def _decodeNull(self, buf, pos): return None, pos
+    def _decodeUndefined(self, buf, pos): return undefined, pos
+    def _decodeReference(self, buf, pos): return _ref(self._obj_refs, _u16.unpack_from(buf, pos)[0]), pos+2
+    def _decodeEcmaArray(self, buf, pos):
+        obj, pos = self._created(dict()), pos+4 # ignore length
+        decodeString, decode, end = self._decodeString, self.decode, chr(AMF0.OBJECT_END)
+        while True:
+            key, pos = decodeString(buf, pos)
+            if key == '' and buf[pos] == end: return obj, pos+1
+            obj[int(key) if key.isdigit() else key], pos = decode(buf, pos)
+    def _decodeArray(self, buf, pos):
+        count, obj, pos, decode = _u32.unpack_from(buf, pos)[0], self._created([]), pos+4, self.decode
+        for i in xrange(count): value, pos = decode(buf, pos); obj.append(value)
+        return obj, pos
+    def _decodeDate(self, buf, pos): return AMF0._date(_double.unpack_from(buf, pos)[0], _s16.unpack_from(buf, pos+8)[0]), pos+10
+    def _decodeXML(self, buf, pos):
+        data, pos = self._decodeLongString(buf, pos)
+        return ET.fromstring(data), pos
+    def _decodeTypedObject(self, buf, pos):
+        classname, pos = self._decodeString(buf, pos)
+        obj, pos = self._decodeObject(buf, pos); obj._classname = classname
+        return obj, pos
+    def _decodeAMF3(self, buf, pos): return AMF3().decode(buf, pos)
+    _decoders = (_decodeNumber, _decodeBool, _decodeString, _decodeObject, _decodeNotImplemented, _decodeNull, _decodeUndefined, _decodeReference, _decodeEcmaArray,
+                 None, _decodeArray, _decodeDate, _decodeLongString, _decodeNull, _decodeNotImplemented, _decodeXML, _decodeTypedObject, _decodeAMF3) # indexed by marker
+
     
 class AMF3(object):
     UNDEFINED, NULL, BOOL_FALSE, BOOL_TRUE, INTEGER, NUMBER, STRING, XML, DATE, ARRAY, OBJECT, XMLSTRING, BYTEARRAY = range(0x0d)
     ANONYMOUS, TYPED, DYNAMIC, EXTERNALIZABLE = 0x01, 0x02, 0x04, 0x08
     
     def __init__(self, data=None):
-        self._obj_refs, self._str_refs, self._class_refs = list(), list(), list()
+        self._obj_refs, self._str_refs, self._class_refs = _References(), _References(), _References()
         self.data = data if isinstance(data, BytesIO) else BytesIO(data) if data is not None else BytesIO()
 
-    def read(self):
-        global undefined
-        type = self.data.read_u8()
-        if   type == AMF3.UNDEFINED:  return undefined
-        elif type == AMF3.NULL:       return None
-        elif type == AMF3.BOOL_FALSE: return False
-        elif type == AMF3.BOOL_TRUE:  return True
-        elif type == AMF3.INTEGER:    return self.readInteger()
-        elif type == AMF3.NUMBER:     return self.data.read_double()
-        elif type == AMF3.STRING:     return self.readString()
-        elif type == AMF3.XML:        return self.readXML()
-        elif type == AMF3.DATE:       return self.readDate()
-        elif type == AMF3.ARRAY:      return self.readArray()
-        elif type == AMF3.OBJECT:     return self.readObject()
-        elif type == AMF3.XMLSTRING:  return self.readXMLString()
-        elif type == AMF3.BYTEARRAY:  return self.readByteArray()
-        else: raise ValueError('Invalid AMF3 type 0x%02x at %d' % (type, self.data.tell()-1))
+    def read(self): # decode the next value at the current position of data, and move the position past it.
+        return _read(self, self.data)
+    def decode(self, buf, pos): # decode the value in str or buffer at offset pos, and return (value, offset after it).
+        type = ord(buf[pos])
+        if type >= len(AMF3._decoders): raise ValueError('Invalid AMF3 type 0x%02x at %d' % (type, pos))
+        return AMF3._decoders[type](self, buf, pos+1)
     
     def write(self, data):
         global undefined
@@ -241,7 +283,7 @@ class AMF3(object):
         return (val >> 1, val & 0x01 == 0)
     
     def readInteger(self, signed=True):
-        self.data.read_u29() if not signed else self.data.read_s29()
+        return self.data.read_u29() if not signed else self.data.read_s29()
     def writeNumber(self, data, writeType=True, type=None):
         if type is None: type = AMF3.INTEGER if isinstance(data, (int, long)) and -0x10000000 <= data <= 0x0FFFFFFF else AMF3.NUMBER
         if writeType: self.data.write_u8(type)
@@ -265,11 +307,12 @@ class AMF3(object):
         if len(data) == 0: self.data.write_u8(0x01)
         elif not self._writePossibleReference(data, refs):
             if encode and type(data) is unicode: data = unicode(data).encode('utf8')
-            self.data.write_u29((len(data) << 1) & 0x01)
+            self.data.write_u29((len(data) << 1) | 0x01)
             self.data.write(data)
         
     def _writePossibleReference(self, data, refs):
-        if data in refs: self.data.write_u29(refs.index(data) << 1); return True
+        index = refs.find(data)
+        if index is not None: self.data.write_u29(index << 1); return True
         elif len(refs) < 0x1ffffffe: refs.append(data)
     
     # Ported from http://viewvc.rubyforge.mmmultiworks.com/cgi/viewvc.cgi/trunk/lib/ruva/class.rb
@@ -294,7 +337,7 @@ class AMF3(object):
     def readDate(self):
         length, is_reference = self._readLengthRef()
         if is_reference: return self._obj_refs[length]
-        ms = self.data.read_double(),
+        ms = self.data.read_double()
         ts =  datetime.datetime.fromtimestamp(ms/1000.0)
         self._obj_refs.append(ts)
         return ts
@@ -322,7 +365,7 @@ class AMF3(object):
     def writeList(self, data):
         self.data.write_u8(AMF3.ARRAY)
         if not self._writePossibleReference(data, refs=self._obj_refs):
-            self.data.write_u29((len(data) << 1) & 0x01)
+            self.data.write_u29((len(data) << 1) | 0x01)
             self.data.write_u8(0x01) # empty key, value
             for val in data: self.write(val)
     def writeDict(self, data, mixed=True):
@@ -338,7 +381,7 @@ class AMF3(object):
                     str_keys.extend(int_keys); int_keys[:] = []
             else:
                 int_keys, str_keys = [], data.keys()
-            self.data.write_u29((len(int_keys) << 1) & 0x01)
+            self.data.write_u29((len(int_keys) << 1) | 0x01)
             for key in str_keys: self.writeString(str(key), writeType=False); self.write(data[key])
             self.data.write_u8(0x01)
             for key in int_keys: self.write(data[key])
@@ -370,10 +413,11 @@ class AMF3(object):
         if not self._writePossibleReference(data, refs=self._obj_refs):
             if isinstance(data, Object) and hasattr(data, '_class'):
                 class_ = data._class
-                if class_ in self._class_refs:
-                    self.data.write_u29((self._class_refs.index(class_) << 2) | 0x01)
+                index = self._class_refs.find(class_)
+                if index is not None:
+                    self.data.write_u29((index << 2) | 0x01)
                 else:
-                    is_dynamic = 0x80 if class_.encoding & AMF3.DYNAMIC else 0
+                    is_dynamic = 0x08 if class_.encoding & AMF3.DYNAMIC else 0
                     attr_len = len(class_.attrs) if hasattr(class_, 'attrs') and class_.attrs else 0
                     self.data.write_u29((attr_len << 4) | 0x03 | is_dynamic)
                     if hasattr(class_, 'name') and class_.name: self.writeString(class_.name, writeType=False)
@@ -383,7 +427,7 @@ class AMF3(object):
                 for attr in class_.attrs: self.write(getattr(data, attr))
                 if class_.encoding & AMF3.DYNAMIC:
                     for key, value in data.__dict__.items():
-                        if key not in class_.attrs:
+                        if key not in class_.attrs and not key.startswith('_'):
                             self.writeString(key, writeType=False)
                             self.write(getattr(data, key))
                     self.data.write_u8(0x01)
@@ -391,6 +435,7 @@ class AMF3(object):
                 self.data.write_u29(0x0b) # no typed attr, dynamic, class def
                 self.data.write_u8(0x01)  # anonymous
                 for key, value in data.__dict__.items():
+                    if key.startswith('_'): continue
                     self.writeString(key, writeType=False)
                     self.write(getattr(data, key)) 
                 self.data.write_u8(0x01) 
@@ -414,6 +459,163 @@ class AMF3(object):
         self.data.write_u8(AMF3.BYTEARRAY)
         self.writeString(data, writeType=False, refs=self._obj_refs, encode=False)
 
+    # decoders of decode() indexed by type, similar to AMF0
+    @staticmethod
+    def _u29(buf, pos): # return (uint29, offset after it)
+        b = ord(buf[pos])
+        if b < 0x80: return b, pos+1
+        result, b = b & 0x7f, ord(buf[pos+1])
+        if b < 0x80: return (result << 7) | b, pos+2
+        result, b = (result << 7) | (b & 0x7f), ord(buf[pos+2])
+        if b < 0x80: return (result << 7) | b, pos+3
+        return (((result << 7) | (b & 0x7f)) << 8) | ord(buf[pos+3]), pos+4
+    def _decodeUndefined(self, buf, pos): return undefined, pos
+    def _decodeNull(self, buf, pos): return None, pos
+    def _decodeFalse(self, buf, pos): return False, pos
+    def _decodeTrue(self, buf, pos): return True, pos
+    def _decodeInteger(self, buf, pos):
+        result, pos = AMF3._u29(buf, pos)
+        return (result - 0x20000000 if result & 0x10000000 else result), pos
+    def _decodeNumber(self, buf, pos): return _double.unpack_from(buf, pos)[0], pos+8
+    def _decodeString(self, buf, pos, refs=None, decode=True):
+        val, pos = AMF3._u29(buf, pos)
+        if refs is None: refs = self._str_refs
+        if val & 0x01 == 0: return _ref(refs, val >> 1), pos
+        end = pos + (val >> 1)
+        if end == pos: return '', pos
+        if end > len(buf): raise EOFError
+        result = buf[pos:end]
+        if decode:
+            try: result = unicode(result, 'utf8')
+            except UnicodeDecodeError: result = AMF3._decode_utf8_modified(result)
+        refs.append(result)
+        return result, end
+    def _decodeXML(self, buf, pos):
+        data, pos = self._decodeString(buf, pos, refs=self._obj_refs)
+        return ET.fromstring(data), pos
+    def _decodeDate(self, buf, pos):
+        val, pos = AMF3._u29(buf, pos)
+        if val & 0x01 == 0: return _ref(self._obj_refs, val >> 1), pos
+        ts = datetime.datetime.fromtimestamp(_double.unpack_from(buf, pos)[0]/1000.0)
+        self._obj_refs.append(ts)
+        return ts, pos+8
+    def _decodeArray(self, buf, pos):
+        val, pos = AMF3._u29(buf, pos)
+        if val & 0x01 == 0: return _ref(self._obj_refs, val >> 1), pos
+        decodeString, decode = self._decodeString, self.decode
+        key, pos = decodeString(buf, pos)
+        if key == '': # return python list since only integer index
+            result = []
+            for i in xrange(val >> 1): value, pos = decode(buf, pos); result.append(value)
+        else: # return python dict with key, value
+            result = {}
+            while key != '': result[key], pos = decode(buf, pos); key, pos = decodeString(buf, pos)
+            for i in xrange(val >> 1): result[i], pos = decode(buf, pos)
+        self._obj_refs.append(result)
+        return result, pos
+    def _decodeObject(self, buf, pos):
+        val, pos = AMF3._u29(buf, pos)
+        if val & 0x01 == 0: return _ref(self._obj_refs, val >> 1), pos
+        type = val >> 1
+        if type & 0x03 == 0x03: raise ValueError('externalizable object is not implemented')
+        elif type & 0x01 == 0: class_ = _ref(self._class_refs, type >> 1)
+        else: # class information
+            class_ = Class()
+            class_.name, pos = self._decodeString(buf, pos)
+            class_.attrs, class_.encoding = [], 0
+            for i in xrange(type >> 3): attr, pos = self._decodeString(buf, pos); class_.attrs.append(attr)
+            if type & 0x04 != 0: class_.encoding |= AMF3.DYNAMIC
+            if not class_.name: class_.encoding |= AMF3.ANONYMOUS
+            if len(class_.attrs) > 0: class_.encoding |= AMF3.TYPED
+            self._class_refs.append(class_)
+        obj, decode = Object(_class=class_), self.decode
+        for attr in class_.attrs: value, pos = decode(buf, pos); setattr(obj, attr, value)
+        if class_.encoding & AMF3.DYNAMIC:
+            attr, pos = self._decodeString(buf, pos)
+            while attr != '': value, pos = decode(buf, pos); setattr(obj, attr, value); attr, pos = self._decodeString(buf, pos)
+        self._obj_refs.append(obj)
+        return obj, pos
+    def _decodeXMLString(self, buf, pos): return self._decodeString(buf, pos, refs=self._obj_refs)
+    def _decodeByteArray(self, buf, pos): return self._decodeString(buf, pos, refs=self._obj_refs, decode=False)
+    _decoders = (_decodeUndefined, _decodeNull, _decodeFalse, _decodeTrue, _decodeInteger, _decodeNumber, _decodeString, _decodeXML, _decodeDate, _decodeArray,
+                 _decodeObject, _decodeXMLString, _decodeByteArray) # indexed by type
+
+
+def _read(amf, data): # decode with amf from the current position of BytesIO data in place, and move the position past it.
+    buf, pos = data.getbuffer()
+    if pos >= len(buf): raise EOFError
+    try: value, pos = amf.decode(buf, pos)
+    except (IndexError, struct.error): raise EOFError # truncated data
+    data.seek(pos)
+    return value
+
+class Slot(object): # a placeholder for a variable value in a Template, e.g., Slot('id')
+    def __init__(self, name): self.name = name
+    def __repr__(self): return 'amf.Slot(%r)' % (self.name,)
+
+class _TemplateWriter(AMF0): # split the encoded data at each Slot, including those in nested values
+    def __init__(self): AMF0.__init__(self); self.parts = []
+    def writeSlot(self, data): self.parts.extend([self.data.getvalue(), data]); self.data.seek(0); self.data.truncate()
+
+class Template(object):
+    '''AMF0 encoding of a sequence of values with Slot placeholders, e.g., Template('onStatus', Slot('id'), None, Object(code=...)).
+    The constant parts are encoded once, and encode(**values) encodes only the slot values between them. A slot value must be
+    a number, string or bool, as an object or array would need the references of the objects in the constant parts.'''
+    def __init__(self, *values):
+        writer = _TemplateWriter()
+        for value in values: writer.write(value)
+        self.parts = writer.parts + [writer.data.getvalue()]
+    def encode(self, **values): # return the encoded str with the given value for each slot name
+        return ''.join([part if isinstance(part, str) else Template._encode(values[part.name]) for part in self.parts])
+    @staticmethod
+    def _encode(value):
+        if isinstance(value, bool): return '\x01' + ('\x01' if value else '\x00')
+        if isinstance(value, (int, long, float)): return '\x00' + _double.pack(value)
+        if isinstance(value, unicode): value = value.encode('utf8')
+        if isinstance(value, str):
+            if len(value) <= 0xffff: return '\x02' + _u16.pack(len(value)) + value
+            return '\x0c' + _u32.pack(len(value)) + value
+        raise ValueError('Invalid amf.Slot value %r type %r, must be a number, string or bool' % (value, type(value)))
+
+
+def _benchDecode(count=10000):
+    '''Measure the decoding time of typical command and data payloads.
+    $ python -c "import amf; amf._benchDecode()"
+    '''
+    def encode(*values):
+        writer = AMF0()
+        for value in values: writer.write(value)
+        return writer.data.getvalue()
+    connect = encode('connect', 1.0, Object(app='live', flashVer='FMLE/3.0 (compatible; FMSc/1.0)', swfUrl='rtmp://localhost/live', tcUrl='rtmp://localhost/live',
+        fpad=False, capabilities=239.0, audioCodecs=3575.0, videoCodecs=252.0, videoFunction=1.0, pageUrl=None, objectEncoding=0.0))
+    publish = encode('publish', 5.0, None, 'livestream', 'live')
+    onStatus = encode('onStatus', 0.0, None, Object(level='status', code='NetStream.Publish.Start', description='livestream is now published', details='livestream', clientid=1.0))
+    onMetaData = encode('onMetaData', {'duration': 0.0, 'width': 640.0, 'height': 480.0, 'videodatarate': 500.0, 'framerate': 30.0, 'videocodecid': 7.0,
+        'audiodatarate': 96.0, 'audiosamplerate': 44100.0, 'audiosamplesize': 16.0, 'stereo': True, 'audiocodecid': 10.0, 'encoder': 'Lavf52.87.1', 'filesize': 0.0,
+        'keyframes': Object(times=[i * 2.0 for i in xrange(30)], filepositions=[i * 250000.0 for i in xrange(30)])})
+    amf3 = encode('onCall3', 2.0, None) + '\x11\x0a\x0b\x01\x09name\x06\x0dkundan\x0bcount\x04\x81\x00\x09tags\x09\x05\x01\x06\x05a1\x06\x00\x01' # AMF3 object
+    for name, payload in (('connect', connect), ('publish', publish), ('onStatus', onStatus), ('onMetaData', onMetaData), ('amf3', amf3)):
+        start = time.time()
+        for i in xrange(count):
+            reader, values = AMF0(payload), []
+            try:
+                while True: values.append(reader.read())
+            except EOFError: pass
+        print '%-10s %4d bytes %5.1f us/payload %d values' % (name, len(payload), (time.time() - start) * 1e6 / count, len(values))
+
+def _benchEncode(count=10000):
+    '''Measure the AMF3 encoding time of an array of objects of a typed class with repeated string values, e.g., a user list.
+    $ python -c "import amf; amf._benchEncode()"
+    '''
+    class_ = Class(); class_.name, class_.attrs, class_.encoding = 'User', ['id', 'name', 'group'], AMF3.TYPED
+    users = [Object(_class=class_, id=i, name='user%d' % (i,), group='group%d' % (i % 100,)) for i in xrange(count)]
+    start = time.time()
+    writer = AMF3(); writer.write(users)
+    data = writer.data.getvalue(); elapsed = time.time() - start
+    result = AMF3(data).read()
+    assert [(u.id, u.name, u.group) for u in result] == [(u.id, u.name, u.group) for u in users]
+    print 'encoded %d objects in %d bytes in %.3f sec' % (count, len(data), elapsed)
+
 # Original source was from rtmpy.org's amf.py, util.py with following Copyright.
 # The source in this file has been re-written based on Adobe's AMF0/AMF3 spec.
 #
@@ -133,6 +133,7 @@ raised within a child task is propagated to its parent.  For example:
 """
 
 
+import bisect
 import collections
 import errno
 from functools import partial
@@ -297,6 +298,7 @@ class FDReady(YieldCondition):
         super(FDReady, self).__init__(timeout)
 
         self.fd = (fd if _is_file_descriptor(fd) else fd.fileno())
+        self.owner = fd  # to detect reuse of the fd number by another file
 
         if not (read or write or exc):
             raise ValueError("'read', 'write', and 'exc' cannot all be false")
@@ -544,6 +546,27 @@ def recvfrom(sock, *args, **kwargs):
     return FDAction(sock, sock.recvfrom, args, kwargs, read=True)
 
 
+def recv_into(sock, *args, **kwargs):
+    """
+
+    A task that yields the result of this function will be resumed
+    when sock is readable, and the value of the yield expression will
+    be the number of bytes received from sock into the supplied
+    buffer.  If a timeout keyword is given and is not None, a Timeout
+    exception will be raised in the yielding task if sock is not
+    readable after timeout seconds have elapsed.  Other arguments will
+    be passed to sock.recv_into().  For example:
+
+      try:
+          nbytes = (yield recv_into(sock, buf, 1024, timeout=5))
+      except Timeout:
+          # No data after 5 seconds
+
+    """
+
+    return FDAction(sock, sock.recv_into, args, kwargs, read=True)
+
+
 def send(sock, *args, **kwargs):
     """
 
@@ -702,43 +725,69 @@ class SmartQueue(object):
     Queue.Queue) that can be used for exchanging data between tasks.
     The difference with Queue is that this implements filtering criteria
     on get and allows multiple get to be signalled for the same put. 
-    On the downside, this uses list instead of deque and has lower
-    performance.
+    On the downside, a get with criteria scans the queue and has lower
+    performance.  If the queue has a key function, a get for given
+    key values is found using an index instead.
     
     """
 
-    def __init__(self, contents=(), maxsize=0):
+    def __init__(self, contents=(), maxsize=0, key=None):
         """
 
         Create a new Queue instance.  contents is a sequence (empty by
         default) containing the initial contents of the queue.  If
         maxsize is greater than 0, the queue will hold a maximum of
         maxsize items, and put() will block until space is available
-        in the queue.
+        in the queue.  If key is not None, it is a function that
+        returns the hashable key of an item, used by get(keys=...).
 
         """
 
         self.maxsize = int(maxsize)
-        self._pending =  list(contents)
+        self.key = key
+        self._pending = collections.OrderedDict()  # sequence => item
+        self._index = {}                           # key => sequences
+        self._sequence = 0
+        for item in contents:
+            self._put(item)
 
     def __len__(self):
         'Return the number of items in the queue'
         return len(self._pending)
 
-    def _get(self, criteria=None):
-        #self._pending = filter(lambda x: x[1]<=now, self._pending) # remove expired ones
-        if criteria:
-            found = filter(lambda x: criteria(x), self._pending)   # check any matching criteria
-            if found: 
-                self._pending.remove(found[0])
-                return found[0]
-            else:
-                return None
+    def _get(self, criteria=None, keys=None):
+        # Return (item,) for the first matching item, or None
+        if keys is not None:
+            found = [sequences[0] for sequences in
+                     (self._index.get(key) for key in keys) if sequences]
+            return (self._remove(min(found)) if found else None)
+        elif criteria:
+            for sequence, item in self._pending.iteritems():
+                if criteria(item):
+                    return self._remove(sequence)
+            return None
         else:
-            return self._pending.pop(0) if self._pending else None
+            return (self._remove(next(iter(self._pending)))
+                    if self._pending else None)
+
+    def _remove(self, sequence):
+        item = self._pending.pop(sequence)
+        if self.key is not None:
+            key = self.key(item)
+            sequences = self._index[key]
+            if sequences[0] == sequence:
+                sequences.popleft()
+            else:
+                sequences.remove(sequence)
+            if not sequences:
+                del self._index[key]
+        return (item,)
 
     def _put(self, item):
-        self._pending.append(item)
+        self._sequence += 1
+        self._pending[self._sequence] = item
+        if self.key is not None:
+            self._index.setdefault(self.key(item), collections.deque()).append(self._sequence)
 
     def empty(self):
         'Return True is the queue is empty, False otherwise'
@@ -748,7 +797,7 @@ class SmartQueue(object):
         'Return True is the queue is full, False otherwise'
         return ((len(self) >= self.maxsize) if (self.maxsize > 0) else False)
 
-    def get(self, timeout=None, criteria=None):
+    def get(self, timeout=None, criteria=None, keys=None):
         """
 
         A task that yields the result of this method will be resumed
@@ -764,9 +813,17 @@ class SmartQueue(object):
           except Timeout:
               # No item available after 5 seconds
 
+        If keys is not None, it is a sequence of key values, and the
+        item must have one of these keys instead of matching criteria.
+        For example, with SmartQueue(key=lambda x: x.name):
+
+          item = (yield queue.get(keys=('kundan',)))
+
         """
 
-        return _SmartQueueAction(self, timeout=timeout, criteria=criteria)
+        if (keys is not None) and (self.key is None):
+            raise ValueError('keys require a SmartQueue with key function')
+        return _SmartQueueAction(self, timeout=timeout, criteria=criteria, keys=keys)
 
     def put(self, item, timeout=None):
         """
@@ -794,16 +851,393 @@ class _SmartQueueAction(YieldCondition):
 
     NO_ITEM = object()
 
-    def __init__(self, queue, item=NO_ITEM, timeout=None, criteria=None):
+    def __init__(self, queue, item=NO_ITEM, timeout=None, criteria=None, keys=None):
         super(_SmartQueueAction, self).__init__(timeout)
         if not isinstance(queue, SmartQueue):
             raise TypeError("'queue' must be a SmartQueue instance")
         self.queue = queue
         self.item = item
         self.criteria = criteria
+        self.keys = keys
         self.expires = (timeout is not None) and (time.time() + timeout) or 0
 
 
+################################################################################
+#
+# _SelectPoller and _EpollPoller classes
+#
+################################################################################
+
+
+
+class _SelectPoller(object):
+
+    """
+
+    Poller for FDReady instances using select.select().  A TaskManager
+    adds an FDReady when a task yields it, and removes it when it is
+    ready or times out.  The number of file descriptors is limited by
+    FD_SETSIZE.
+
+    """
+
+    def __init__(self):
+        self._read_waits  = set()
+        self._write_waits = set()
+        self._exc_waits   = set()
+
+    def __len__(self):
+        'Return the number of FDReady instances waiting'
+        return len(self.waits())
+
+    def __nonzero__(self):
+        return bool(self._read_waits or self._write_waits or self._exc_waits)
+
+    def waits(self):
+        'Return the set of FDReady instances waiting'
+        return (self._read_waits | self._write_waits | self._exc_waits)
+
+    def add(self, fd):
+        fd._add_to_fdsets(self._read_waits, self._write_waits, self._exc_waits)
+
+    def remove(self, fd):
+        fd._remove_from_fdsets(self._read_waits, self._write_waits, self._exc_waits)
+
+    def poll(self, timeout):
+        """
+
+        Wait up to timeout seconds, or indefinitely if timeout is None,
+        and return the list of ready FDReady instances.  Errors from
+        select() are raised to the caller.
+
+        """
+
+        read_ready, write_ready, exc_ready = \
+            select.select(self._read_waits,
+                          self._write_waits,
+                          self._exc_waits,
+                          timeout)
+        return list(set(read_ready + write_ready + exc_ready))
+
+    def remove_bad(self):
+        'Remove and return the list of FDReady instances with bad file descriptors'
+        bad = []
+        for fd in self.waits():
+            try:
+                select.select([fd], [fd], [fd], 0.0)
+            except:
+                self.remove(fd)
+                bad.append(fd)
+        return bad
+
+
+class _EpollPoller(object):
+
+    """
+
+    Poller for FDReady instances using level-triggered select.epoll().
+    A file descriptor stays registered as long as some FDReady waits on
+    it, and the registration is updated lazily before the next poll()
+    only for the file descriptors whose waiting FDReady set changed.
+    Hence a task that repeatedly waits on the same socket does not
+    cause any epoll_ctl() call, and there is no FD_SETSIZE limit.  A
+    file descriptor that epoll does not support, e.g. a regular file,
+    is always ready, same as with select().
+
+    """
+
+    def __init__(self):
+        self._epoll   = select.epoll()
+        self._waits   = {}     # fd number => set of FDReady
+        self._masks   = {}     # fd number => registered event mask
+        self._owners  = {}     # fd number => registered file or socket
+        self._dirty   = set()  # fd numbers with changed waits
+        self._always  = set()  # fd numbers not supported by epoll
+        self._bad     = []     # FDReady with bad file descriptors
+        self._count   = 0
+
+    def __len__(self):
+        'Return the number of FDReady instances waiting'
+        return self._count
+
+    def __nonzero__(self):
+        return self._count > 0
+
+    def waits(self):
+        'Return the set of FDReady instances waiting'
+        return set(fd for fds in self._waits.itervalues() for fd in fds)
+
+    def add(self, fd):
+        fds = self._waits.get(fd.fd)
+        if fds is None:
+            fds = self._waits[fd.fd] = set()
+        if fd not in fds:
+            fds.add(fd)
+            self._count += 1
+            self._dirty.add(fd.fd)
+
+    def remove(self, fd):
+        fds = self._waits.get(fd.fd)
+        if fds is not None and fd in fds:
+            fds.discard(fd)
+            self._count -= 1
+            self._dirty.add(fd.fd)
+
+    @staticmethod
+    def _mask(fds):
+        mask = 0
+        for fd in fds:
+            if fd.read: mask |= select.EPOLLIN
+            if fd.write: mask |= select.EPOLLOUT
+            if fd.exc: mask |= select.EPOLLPRI
+        return mask
+
+    def _update(self):
+        for number in self._dirty:
+            fds = self._waits.get(number)
+            if not fds:
+                self._waits.pop(number, None)
+                self._owners.pop(number, None)
+                self._always.discard(number)
+                if self._masks.pop(number, 0):
+                    try:
+                        self._epoll.unregister(number)
+                    except (IOError, OSError):
+                        pass  # already closed
+                continue
+            if number in self._always:
+                continue
+            mask, owner = self._mask(fds), iter(fds).next().owner
+            new = (owner is not self._owners.get(number))
+            if mask == self._masks.get(number) and not new:
+                continue
+            try:
+                self._ctl(number, mask, new)
+                self._masks[number], self._owners[number] = mask, owner
+            except (IOError, OSError), err:
+                self._masks.pop(number, None)
+                self._owners.pop(number, None)
+                if err.errno == errno.EPERM:
+                    self._always.add(number)
+                elif err.errno in (errno.EBADF, errno.ENOENT):
+                    for fd in fds:
+                        self._bad.append(fd)
+                    self._count -= len(fds)
+                    del self._waits[number]
+                else:
+                    raise
+        self._dirty.clear()
+
+    def _ctl(self, number, mask, new):
+        if number in self._masks and not new:
+            try:
+                self._epoll.modify(number, mask)
+            except (IOError, OSError), err:
+                if err.errno != errno.ENOENT:
+                    raise
+                self._epoll.register(number, mask)
+        else:
+            # a new file with the same fd number is usually not registered
+            # because closing the old one removed it from epoll
+            try:
+                self._epoll.register(number, mask)
+            except (IOError, OSError), err:
+                if err.errno != errno.EEXIST:
+                    raise
+                self._epoll.modify(number, mask)
+
+    def poll(self, timeout):
+        """
+
+        Wait up to timeout seconds, or indefinitely if timeout is None,
+        and return the list of ready FDReady instances.  Errors from
+        epoll.poll() are raised to the caller.
+
+        """
+
+        self._update()
+        if self._bad:
+            raise IOError(errno.EBADF, 'Bad file descriptor')
+        if self._always:
+            timeout = 0.0
+        events = self._epoll.poll(-1 if timeout is None else timeout)
+        ready = [fd for number in self._always for fd in self._waits[number]]
+        for number, event in events:
+            if event & (select.EPOLLERR | select.EPOLLHUP):
+                # same as select(), which reports errors as ready
+                event |= select.EPOLLIN | select.EPOLLOUT
+            for fd in self._waits.get(number, ()):
+                if ((fd.read and event & select.EPOLLIN) or
+                    (fd.write and event & select.EPOLLOUT) or
+                    (fd.exc and event & select.EPOLLPRI)):
+                    ready.append(fd)
+        return ready
+
+    def remove_bad(self):
+        'Remove and return the list of FDReady instances with bad file descriptors'
+        self._update()
+        bad, self._bad = self._bad, []
+        return bad
+
+
+################################################################################
+#
+# _TimerHeap class
+#
+################################################################################
+
+
+
+class _TimerHeap(object):
+
+    """
+
+    Heap of pending timers with lazy deletion.  An entry is a list
+    [expiration, sequence, item], and cancel() only clears the item of
+    the entry in O(1), instead of removing it from the heap in O(n).
+    Cancelled entries are skipped when they reach the top of the heap,
+    and the heap is compacted when they are more than half of it.  The
+    item can be anything, e.g., a YieldCondition of the TaskManager or
+    a callable of the rtmfp server.
+
+    """
+
+    def __init__(self):
+        self._heap  = []
+        self._count = 0  # number of entries not cancelled
+        self._seq   = 0
+
+    def __len__(self):
+        'Return the number of pending (not cancelled) timers'
+        return self._count
+
+    def push(self, expiration, item):
+        'Add item to expire at expiration, and return the entry to cancel it'
+        entry = [expiration, self._seq, item]
+        self._seq += 1
+        heapq.heappush(self._heap, entry)
+        self._count += 1
+        return entry
+
+    def cancel(self, entry):
+        'Cancel the entry returned by push(), if it is not expired or cancelled yet'
+        if entry is not None and entry[2] is not None:
+            entry[2] = None
+            self._count -= 1
+            if len(self._heap) > 64 and self._count < len(self._heap) // 2:
+                self._heap[:] = [e for e in self._heap if e[2] is not None]
+                heapq.heapify(self._heap)
+
+    def first(self):
+        'Return the earliest expiration, or None if there is no pending timer'
+        heap = self._heap
+        while heap and heap[0][2] is None:
+            heapq.heappop(heap)
+        return (heap[0][0] if heap else None)
+
+    def expired(self, current_time):
+        'Remove and return the list of items expired at current_time'
+        heap, expired = self._heap, []
+        while heap and heap[0][0] <= current_time:
+            entry = heapq.heappop(heap)
+            if entry[2] is not None:
+                expired.append(entry[2])
+                entry[2] = None
+                self._count -= 1
+        return expired
+
+    def merge(self, other):
+        'Move the pending entries of other, which remain valid to cancel'
+        for entry in other._heap:
+            if entry[2] is not None:
+                entry[1] = self._seq
+                self._seq += 1
+                heapq.heappush(self._heap, entry)
+                self._count += 1
+        other._heap, other._count = [], 0
+
+
+
+################################################################################
+#
+# TaskStats class
+#
+################################################################################
+
+
+
+class TaskStats(object):
+
+    """
+
+    Optional statistics of a TaskManager, collected when its stats
+    attribute is set to an instance of this class.  For example:
+
+      stats = get_default_task_manager().stats = TaskStats(0.02, warn)
+      ...
+      print stats.summary()
+
+    where warn(name, duration, task) is called when a task runs for
+    more than 0.02 seconds before yielding.  The attributes are:
+
+      tasks: dict of generator function name => [run time, resumes]
+      loops: histogram of the time to run all runnable tasks in one
+             iteration of run_next(), with upper bounds in BUCKETS
+      wait_time, run_time: total time waiting for I/O or timeouts,
+             and running the tasks
+      slow:  number of resumes that took more than threshold
+
+    """
+
+    BUCKETS = (0.0001, 0.001, 0.01, 0.1, 1.0, float('inf'))
+
+    def __init__(self, threshold=None, callback=None):
+        self.threshold = threshold
+        self.callback = callback
+        self.reset()
+
+    def reset(self):
+        'Clear all the collected statistics'
+        self.tasks = {}
+        self.loops = [0] * len(self.BUCKETS)
+        self.wait_time = self.run_time = 0.0
+        self.slow = 0
+
+    @staticmethod
+    def name(task):
+        'Return the generator function name of task'
+        while isinstance(task, _ChildTask):
+            task = task.task
+        code = getattr(task, 'gi_code', None)
+        return (code.co_name if code is not None else repr(task))
+
+    def _resumed(self, task, started):
+        duration = time.time() - started
+        name = self.name(task)
+        entry = self.tasks.get(name)
+        if entry is None:
+            entry = self.tasks[name] = [0.0, 0]
+        entry[0] += duration
+        entry[1] += 1
+        if (self.threshold is not None) and (duration > self.threshold):
+            self.slow += 1
+            if self.callback is not None:
+                self.callback(name, duration, task)
+
+    def _looped(self, duration):
+        self.run_time += duration
+        self.loops[bisect.bisect_left(self.BUCKETS, duration)] += 1
+
+    def summary(self, count=10):
+        'Return a printable summary with the count tasks that ran longest'
+        lines = ['wait %.3fs run %.3fs slow %d' % (self.wait_time, self.run_time, self.slow),
+                 'loops ' + ' '.join('<=%gs:%d' % (bound, loops) for bound, loops in zip(self.BUCKETS, self.loops))]
+        for name, (run_time, resumes) in sorted(self.tasks.iteritems(), key=lambda x: -x[1][0])[:count]:
+            lines.append('%-30s %10.6fs %8d resumes' % (name, run_time, resumes))
+        return '\n'.join(lines)
+
+
+
 ################################################################################
 #
 # TaskManager class
@@ -821,7 +1255,17 @@ class TaskManager(object):
 
     """
 
-    def __init__(self):
+    # select.epoll is used if available, else select.select
+    poller = (_EpollPoller if hasattr(select, 'epoll') else _SelectPoller)
+
+    # set to a TaskStats instance to collect statistics in run_next()
+    stats = None
+
+    # maximum number of steps of a task and its nested generators run
+    # in one turn, before the task goes back to the end of the queue
+    inline_steps = 100
+
+    def __init__(self, poller=None):
         """
 
         Create a new TaskManager instance.  Generally, there will only
@@ -829,14 +1273,16 @@ class TaskManager(object):
         existing instances simultaneously, merge them first, then run
         one or the other.
 
+        The poller argument is the class used to wait for I/O, e.g.
+        _SelectPoller, and defaults to the poller class attribute.
+
         """
 
         self._queue       = collections.deque()
-        self._read_waits  = set()
-        self._write_waits = set()
-        self._exc_waits   = set()
+        self._poller      = (poller or self.poller)()
         self._queue_waits = collections.defaultdict(self._double_deque)
-        self._timeouts    = []
+        self._key_waits   = collections.defaultdict(dict)
+        self._timeouts    = _TimerHeap()
 
     @staticmethod
     def _double_deque():
@@ -856,21 +1302,19 @@ class TaskManager(object):
 
         # Merge the data structures
         self._queue.extend(other._queue)
-        self._read_waits  |= other._read_waits
-        self._write_waits |= other._write_waits
-        self._exc_waits   |= other._exc_waits
+        for fd in other._poller.waits():
+            self._poller.add(fd)
         self._queue_waits.update(other._queue_waits)
-        self._timeouts.extend(other._timeouts)
-        heapq.heapify(self._timeouts)
+        self._key_waits.update(other._key_waits)
+        self._timeouts.merge(other._timeouts)
 
         # Make other reference the merged data structures.  This is
         # necessary because other's tasks may reference and use other
         # (e.g. to add a new task in response to an event).
         other._queue       = self._queue
-        other._read_waits  = self._read_waits
-        other._write_waits = self._write_waits
-        other._exc_waits   = self._exc_waits
+        other._poller      = self._poller
         other._queue_waits = self._queue_waits
+        other._key_waits   = self._key_waits
         other._timeouts    = self._timeouts
 
     def add(self, task):
@@ -912,7 +1356,7 @@ class TaskManager(object):
         otherwise
 
         """
-        return bool(self._read_waits or self._write_waits or self._exc_waits)
+        return bool(self._poller)
 
     def has_timeouts(self):
         """
@@ -947,39 +1391,79 @@ class TaskManager(object):
 
         """
 
+        stats = self.stats
+        if stats is not None:
+            wait_started = time.time()
+
         while self.has_io_waits():
             if self._handle_io_waits(self._fix_run_timeout(timeout)) or self.has_runnable(): break
 
         if self.has_timeouts():
             self._handle_timeouts(self._fix_run_timeout(timeout))
 
-        # Run all tasks currently in the queue
+        if stats is not None:
+            run_started = time.time()
+            stats.wait_time += run_started - wait_started
+
+        # Run all tasks currently in the queue.  A yielded generator
+        # is run at once as a child task, and a finished child resumes
+        # its parent at once.  A queue get or put that completes at
+        # once also resumes the task at once, so that only a blocking
+        # YieldCondition or other output goes through the queue.
         #for dummy in xrange(len(self._queue)):
         while len(self._queue) > 0:
             task, input, exc_info = self._queue.popleft()
-            try:
-                if exc_info:
-                    output = task.throw(*exc_info)
-                else:
-                    output = task.send(input)
-            except StopIteration, e:
-                if isinstance(task, _ChildTask):
-                    if not e.args:
-                        output = None
-                    elif len(e.args) == 1:
-                        output = e.args[0]
+            steps = self.inline_steps
+            while task is not None:
+                resumed, started = task, (stats is not None) and time.time()
+                try:
+                    if exc_info:
+                        output = task.throw(*exc_info)
                     else:
-                        output = e.args
-                    self._enqueue(task.parent, input=output)
-            except:
-                if isinstance(task, _ChildTask):
-                    # Propagate exception to parent
-                    self._enqueue(task.parent, exc_info=sys.exc_info())
+                        output = task.send(input)
+                except StopIteration, e:
+                    if isinstance(task, _ChildTask):
+                        if not e.args:
+                            output = None
+                        elif len(e.args) == 1:
+                            output = e.args[0]
+                        else:
+                            output = e.args
+                        task, input, exc_info = task.parent, output, ()
+                    else:
+                        task = None
+                except:
+                    if isinstance(task, _ChildTask):
+                        # Propagate exception to parent
+                        task, input, exc_info = task.parent, None, sys.exc_info()
+                    else:
+                        # No parent task, so just die
+                        raise
                 else:
-                    # No parent task, so just die
-                    raise
-            else:
-                self._handle_task_output(task, output)
+                    if isinstance(output, types.GeneratorType):
+                        task, input, exc_info = _ChildTask(task, output), None, ()
+                    else:
+                        if type(output) is _QueueAction:
+                            # Fast path of _handle_task_output()
+                            output.task = task
+                            resume = self._handle_queue_action(task, output)
+                        else:
+                            resume = self._handle_task_output(task, output)
+                        if resume is None:
+                            task = None
+                        else:
+                            input, exc_info = resume[0], ()
+                finally:
+                    if started:
+                        stats._resumed(resumed, started)
+                steps -= 1
+                if (task is not None) and (steps <= 0):
+                    # Let other tasks run before continuing
+                    self._enqueue(task, input, exc_info)
+                    task = None
+
+        if stats is not None:
+            stats._looped(time.time() - run_started)
 
     def _fix_run_timeout(self, timeout):
         if self.has_runnable():
@@ -987,7 +1471,7 @@ class TaskManager(object):
             timeout = 0.0
         elif self.has_timeouts():
             # If there are timeouts, block only until the first expiration
-            expiration_timeout = max(0.0, self._timeouts[0][0] - time.time())
+            expiration_timeout = max(0.0, self._timeouts.first() - time.time())
             if (timeout is None) or (timeout > expiration_timeout):
                 timeout = expiration_timeout
         return timeout
@@ -995,11 +1479,7 @@ class TaskManager(object):
     def _handle_io_waits(self, timeout):
         # The error handling here is (mostly) borrowed from Twisted
         try:
-            read_ready, write_ready, exc_ready = \
-                select.select(self._read_waits,
-                              self._write_waits,
-                              self._exc_waits,
-                              timeout)
+            ready = self._poller.poll(timeout)
         except (TypeError, ValueError):
             self._remove_bad_file_descriptors()
             return False
@@ -1015,40 +1495,32 @@ class TaskManager(object):
                 # Not an error we can handle, so die
                 raise
         else:
-            for fd in set(read_ready + write_ready + exc_ready):
+            for fd in ready:
                 try:
                     input = (fd._eval() if isinstance(fd, FDAction) else None)
                     self._enqueue(fd.task, input=input)
                 except:
                     self._enqueue(fd.task, exc_info=sys.exc_info())
-                fd._remove_from_fdsets(self._read_waits,
-                                       self._write_waits,
-                                       self._exc_waits)
+                self._poller.remove(fd)
                 if fd._expires():
                     self._remove_timeout(fd)
             return True
 
     def _remove_bad_file_descriptors(self):
-        for fd in (self._read_waits | self._write_waits | self._exc_waits):
-            try:
-                select.select([fd], [fd], [fd], 0.0)
-            except:
-                # TODO: do not enqueue the exception (socket.error) so that it does not crash
-                # when closing an already closed socket. See rtmplite issue #28
-                # self._enqueue(fd.task, exc_info=sys.exc_info())
-                fd._remove_from_fdsets(self._read_waits,
-                                       self._write_waits,
-                                       self._exc_waits)
-                if fd._expires():
-                    self._remove_timeout(fd)
+        for fd in self._poller.remove_bad():
+            # TODO: do not enqueue the exception (socket.error) so that it does not crash
+            # when closing an already closed socket. See rtmplite issue #28
+            # self._enqueue(fd.task, exc_info=sys.exc_info())
+            if fd._expires():
+                self._remove_timeout(fd)
 
     def _add_timeout(self, item, handler):
         item.handle_expiration = handler
-        heapq.heappush(self._timeouts, (item.expiration, item))
+        item._timer = self._timeouts.push(item.expiration, item)
 
     def _remove_timeout(self, item):
-        self._timeouts.remove((item.expiration, item))
-        heapq.heapify(self._timeouts)
+        self._timeouts.cancel(getattr(item, '_timer', None))
+        item._timer = None
 
     def _handle_timeouts(self, timeout):
         if (not self.has_runnable()) and (timeout > 0.0):
@@ -1056,8 +1528,7 @@ class TaskManager(object):
 
         current_time = time.time()
 
-        while self._timeouts and (self._timeouts[0][0] <= current_time):
-            item = heapq.heappop(self._timeouts)[1]
+        for item in self._timeouts.expired(current_time):
             if isinstance(item, _SleepDelay):
                 self._enqueue(item.task)
             else:
@@ -1065,6 +1536,8 @@ class TaskManager(object):
                 item.handle_expiration()
 
     def _handle_task_output(self, task, output):
+        # Return (input,) if task can be resumed at once with input,
+        # else None after arranging for it to be resumed later
         if isinstance(output, types.GeneratorType):
             self._enqueue(_ChildTask(task, output))
         elif isinstance(output, YieldCondition):
@@ -1074,24 +1547,19 @@ class TaskManager(object):
             elif isinstance(output, FDReady):
                 self._handle_fdready(task, output)
             elif isinstance(output, _QueueAction):
-                self._handle_queue_action(task, output)
+                return self._handle_queue_action(task, output)
             elif isinstance(output, _SmartQueueAction):
-                self._handle_smart_queue_action(task, output)
+                return self._handle_smart_queue_action(task, output)
         else:
             # Return any other output as input and send task to
             # end of queue
             self._enqueue(task, input=output)
 
     def _handle_fdready(self, task, output):
-        output._add_to_fdsets(self._read_waits,
-                              self._write_waits,
-                              self._exc_waits)
+        self._poller.add(output)
         if output._expires():
             self._add_timeout(output,
-                              (lambda:
-                               output._remove_from_fdsets(self._read_waits,
-                                                          self._write_waits,
-                                                          self._exc_waits)))
+                              (lambda: self._poller.remove(output)))
 
     def _handle_queue_action(self, task, output):
         get_waits, put_waits = self._queue_waits[output.queue]
@@ -1105,13 +1573,13 @@ class TaskManager(object):
                                       (lambda: get_waits.remove(output)))
             else:
                 item = output.queue._get()
-                self._enqueue(task, input=item)
                 if put_waits:
                     action = put_waits.popleft()
                     output.queue._put(action.item)
                     self._enqueue(action.task)
                     if action._expires():
                         self._remove_timeout(action)
+                return (item,)
         else:
             # Action is a put
             if output.queue.full():
@@ -1121,34 +1589,44 @@ class TaskManager(object):
                                       (lambda: put_waits.remove(output)))
             else:
                 output.queue._put(output.item)
-                self._enqueue(task)
                 if get_waits:
                     action = get_waits.popleft()
                     item = output.queue._get()
                     self._enqueue(action.task, input=item)
                     if action._expires():
                         self._remove_timeout(action)
+                return (None,)
 
 
     def _handle_smart_queue_action(self, task, output):
         get_waits, put_waits = self._queue_waits[output.queue]
+        key_waits = self._key_waits[output.queue]
 
         if output.item is output.NO_ITEM:
             # Action is a get
-            item = output.queue._get(criteria=output.criteria)
-            if item is None:
-                get_waits.append(output)
-                if output._expires():
-                    self._add_timeout(output,
-                                      (lambda: get_waits.remove(output)))
+            found = output.queue._get(criteria=output.criteria,
+                                      keys=output.keys)
+            if found is None:
+                if output.keys is None:
+                    get_waits.append(output)
+                    if output._expires():
+                        self._add_timeout(output,
+                                          (lambda: get_waits.remove(output)))
+                else:
+                    # Index the waiting get by each of its keys
+                    for key in output.keys:
+                        key_waits.setdefault(key, []).append(output)
+                    if output._expires():
+                        self._add_timeout(output,
+                                          (lambda: self._remove_key_wait(key_waits, output)))
             else:
-                self._enqueue(task, input=item)
                 if put_waits:
                     action = put_waits.popleft()
                     output.queue._put(action.item)
                     self._enqueue(action.task)
                     if action._expires():
                         self._remove_timeout(action)
+                return found
         else:
             # Action is a put
             if output.queue.full():
@@ -1158,18 +1636,36 @@ class TaskManager(object):
                                       (lambda: put_waits.remove(output)))
             else:
                 output.queue._put(output.item)
-                self._enqueue(task)
+                if key_waits:
+                    # Wake only the first get waiting for this key
+                    actions = key_waits.get(output.queue.key(output.item))
+                    if actions:
+                        action = actions[0]
+                        self._remove_key_wait(key_waits, action)
+                        found = output.queue._get(keys=action.keys)
+                        self._enqueue(action.task, input=found[0])
+                        if action._expires():
+                            self._remove_timeout(action)
                 if get_waits:
                     actions = []
                     for action in get_waits:
-                        item = output.queue._get(criteria=action.criteria)
-                        if item is not None:
-                            actions.append((action, item))
+                        found = output.queue._get(criteria=action.criteria)
+                        if found is not None:
+                            actions.append((action, found[0]))
                     for action,item in actions:
                         get_waits.remove(action)
                         self._enqueue(action.task, input=item)
                         if action._expires():
                             self._remove_timeout(action)
+                return (None,)
+
+    @staticmethod
+    def _remove_key_wait(key_waits, action):
+        for key in action.keys:
+            actions = key_waits[key]
+            actions.remove(action)
+            if not actions:
+                del key_waits[key]
 
 
 
@@ -1203,6 +1699,139 @@ def run():
 
 
 
+################################################################################
+#
+# Benchmarks
+#
+################################################################################
+
+
+
+def _benchPoller(counts=(100, 1000, 10000), iterations=2000):
+    """
+
+    Print the cost of one run_next() iteration of a busy task while
+    count idle sockets are waiting to be readable, for each poller.
+    Run as:
+
+      $ python -c "import multitask; multitask._benchPoller()"
+
+    """
+
+    import socket
+
+    def idle(sock):
+        yield recv(sock, 1)
+
+    def busy():
+        while True:
+            yield sleep(1e-9)
+
+    for count in counts:
+        try:
+            socks = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                     for i in xrange(count)]
+        except socket.error, e:
+            print '%6d sockets: %s' % (count, e)
+            break
+        for poller in (_SelectPoller, _EpollPoller):
+            if poller is _EpollPoller and not hasattr(select, 'epoll'):
+                continue
+            tm = TaskManager(poller)
+            for sock in socks:
+                tm.add(idle(sock))
+            tm.add(busy())
+            tm.run_next(0.0)
+            start = time.time()
+            for i in xrange(iterations):
+                tm.run_next(0.0)
+            duration = time.time() - start
+            if len(tm._poller) < count:
+                result = 'failed, %d of %d fds waiting' % (len(tm._poller), count)
+            else:
+                result = '%8.1f us/iteration' % (duration * 1e6 / iterations)
+            print '%6d sockets %-13s %s' % (count, poller.__name__, result)
+        for sock in socks:
+            sock.close()
+
+
+
+def _benchTimers(counts=(10000, 100000)):
+    """
+
+    Print the cost per timeout to arm, cancel and expire count pending
+    timeouts in a TaskManager.  Run as:
+
+      $ python -c "import multitask; multitask._benchTimers()"
+
+    """
+
+    for count in counts:
+        tm, now = TaskManager(_SelectPoller), time.time()
+        items = [YieldCondition(timeout=1000 + (i * 7919) % count)
+                 for i in xrange(count)]
+        start = time.time()
+        for item in items:
+            tm._add_timeout(item, None)
+        armed = time.time()
+        for item in items:
+            tm._remove_timeout(item)
+        cancelled = time.time()
+        for item in items:
+            item.expiration = now - 1
+            tm._add_timeout(item, (lambda: None))
+        start2 = time.time()
+        tm._handle_timeouts(0.0)
+        expired = time.time()
+        assert not tm.has_timeouts() and len(tm._queue) == count
+        print '%6d timeouts: arm %.2f us, cancel %.2f us, expire %.2f us' % (
+            count, (armed - start) * 1e6 / count,
+            (cancelled - armed) * 1e6 / count,
+            (expired - start2) * 1e6 / count)
+
+
+
+def _benchQueue(count=100000, hops=3):
+    """
+
+    Print the messages/sec through a chain of producer, hops Queue
+    instances with a relay task between each, and consumer, with and
+    without resuming the tasks at once on queue operations that do
+    not block.  Run as:
+
+      $ python -c "import multitask; multitask._benchQueue()"
+
+    """
+
+    def producer(queue):
+        for i in xrange(count):
+            yield queue.put(i)
+
+    def relay(source, sink):
+        for i in xrange(count):
+            item = yield source.get()
+            yield sink.put(item)
+
+    def consumer(queue, received):
+        for i in xrange(count):
+            received.append((yield queue.get()))
+
+    for inline_steps in (1, TaskManager.inline_steps):
+        tm, received = TaskManager(_SelectPoller), []
+        tm.inline_steps = inline_steps
+        queues = [Queue() for i in xrange(hops)]
+        tm.add(producer(queues[0]))
+        for source, sink in zip(queues[:-1], queues[1:]):
+            tm.add(relay(source, sink))
+        tm.add(consumer(queues[-1], received))
+        start = time.time()
+        tm.run()
+        duration = time.time() - start
+        assert received == range(count)
+        print 'inline_steps %3d: %8d messages/sec' % (inline_steps, count / duration)
+
+
+
 ################################################################################
 #
 # Test routine
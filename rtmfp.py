@@ -427,30 +427,37 @@ Fill in description of the remaining message flows beyond handshake.
 Describe the man-in-middle mode that enables audio/video flowing through the server.
 '''
 
-import os, sys, traceback, urlparse, re, socket, struct, time, random, hmac, hashlib
+import os, sys, traceback, urlparse, re, socket, struct, time, random, hmac, hashlib, array, collections, bisect, heapq, multiprocessing
 import multitask, amf, rtmp
 
 try:
     from Crypto.Cipher import AES
 
+    _xor16 = lambda a, b: struct.pack('>QQ', *[x ^ y for x, y in zip(struct.unpack('>QQ', a), struct.unpack('>QQ', b))])
+
+    # Each packet is encrypted with a null-IV, but one CBC cipher object is reused for all the packets of a session. The
+    # object chains the first block of a packet to the last cipher block of the previous packet, hence that block is XOR'ed
+    # in once more to undo the chaining, i.e., E(P1 ^ C ^ C) = E(P1) and D(C1) ^ C ^ C = D(C1).
     class AESEncrypt(object):
         def __init__(self, key):
             self.key = key[:16]
-            self.iv = ''.join(['\x00' for i in xrange(16)]) # create null-IV
+            self.cipher, self.last = AES.new(self.key, AES.MODE_CBC, '\x00'*16), '\x00'*16 # last cipher block
         def encode(self, data):
-            self.cipher = AES.new(self.key, AES.MODE_CBC, self.iv)
-            result = self.cipher.encrypt(data)
+            if not data: return data
+            result = self.cipher.encrypt(_xor16(data[:16], self.last) + data[16:])
+            self.last = result[-16:]
             return result
     class AESDecrypt(object):
         def __init__(self, key):
             self.key = key[:16]
-            self.iv = ''.join(['\x00' for i in xrange(16)]) # create null-IV
+            self.cipher, self.last = AES.new(self.key, AES.MODE_CBC, '\x00'*16), '\x00'*16
         def decode(self, data):
-            self.cipher = AES.new(self.key, AES.MODE_CBC, self.iv)
+            if not data: return data
             result = self.cipher.decrypt(data)
+            result, self.last = _xor16(result[:16], self.last) + result[16:], data[-16:]
             return result
 except ImportError:
-    print 'WARNING: Please install PyCrypto in your PYTHONPATH for faster performance. Falling back to Python aes.py which is *very* slow'
+    print 'WARNING: Please install PyCrypto in your PYTHONPATH for faster performance. Falling back to Python aes.py which is slow'
     import aes
     
     class AESEncrypt(object):
@@ -574,15 +581,35 @@ _key = 'Adobe Systems 02'
 _int2bin = lambda x, size: (''.join(chr(a) for a in [((x>>c)&0x0ff) for c in xrange((size-1)*8,-8,-8)])) if x is not None else '\x00'*size
 _bin2int = lambda x: long(''.join('%02x'%(ord(a)) for a in x), 16)
 _dh1024p = _bin2int('\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xC9\x0F\xDA\xA2\x21\x68\xC2\x34\xC4\xC6\x62\x8B\x80\xDC\x1C\xD1\x29\x02\x4E\x08\x8A\x67\xCC\x74\x02\x0B\xBE\xA6\x3B\x13\x9B\x22\x51\x4A\x08\x79\x8E\x34\x04\xDD\xEF\x95\x19\xB3\xCD\x3A\x43\x1B\x30\x2B\x0A\x6D\xF2\x5F\x14\x37\x4F\xE1\x35\x6D\x6D\x51\xC2\x45\xE4\x85\xB5\x76\x62\x5E\x7E\xC6\xF4\x4C\x42\xE9\xA6\x37\xED\x6B\x0B\xFF\x5C\xB6\xF4\x06\xB7\xED\xEE\x38\x6B\xFB\x5A\x89\x9F\xA5\xAE\x9F\x24\x11\x7C\x4B\x1F\xE6\x49\x28\x66\x51\xEC\xE6\x53\x81\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF')
-_random = lambda size: ''.join([chr(random.randint(0, 255)) for i in xrange(size)])
+_random = os.urandom # also keeps the forked DH worker processes from generating the same private values
 _bin2hex = lambda data: ''.join(['%02x'%(ord(x),) for x in data])
 
 def _checkSum(data):
     data, last = (data[:-1], ord(data[-1])) if len(data) % 2 != 0 else (data, 0)
-    sum = reduce(lambda x,y: x+y, [(ord(x) << 8 | ord(y)) for x, y in zip(data[::2], data[1::2])], 0) + last
-    sum = (sum >> 16) + (sum & 0xffff)
-    sum += (sum >> 16)
-    return (~sum) & 0xffff
+    words = array.array('H', data) # 16-bit words in native byte order, summed in C
+    if sys.byteorder == 'little': words.byteswap()
+    total = sum(words) + last
+    total = (total >> 16) + (total & 0xffff)
+    total += (total >> 16)
+    return (~total) & 0xffff
+
+def _benchCheckSum(size=1181, count=50000):
+    '''Compare the checksum of RTMFP sized packets with the earlier list based implementation.
+      $ python -c "import rtmfp; rtmfp._benchCheckSum()"
+    '''
+    def checkSum(data): # earlier implementation
+        data, last = (data[:-1], ord(data[-1])) if len(data) % 2 != 0 else (data, 0)
+        sum = reduce(lambda x,y: x+y, [(ord(x) << 8 | ord(y)) for x, y in zip(data[::2], data[1::2])], 0) + last
+        sum = (sum >> 16) + (sum & 0xffff)
+        sum += (sum >> 16)
+        return (~sum) & 0xffff
+    packets = [os.urandom(size + i % 2) for i in xrange(100)] # odd and even lengths
+    assert all(checkSum(p) == _checkSum(p) for p in packets)
+    for name, func, n in (('list', checkSum, count/50), ('array', _checkSum, count)):
+        start = time.time()
+        for i in xrange(n): func(packets[i % 100])
+        elapsed = time.time() - start
+        print '%s: %d packets of %d bytes in %.3f s, %d packets/s'%(name, n, size, elapsed, n/elapsed)
 
 def _decode(decoder, data):
     raw = data[:4] + decoder.decode(data[4:])
@@ -618,6 +645,76 @@ def _endDH(x, y):
 def _asymetricKeys(secret, initNonce, respNonce): # returns (dkey, ekey)
     return (hmac.new(secret, hmac.new(respNonce, initNonce, hashlib.sha256).digest(), hashlib.sha256).digest(), hmac.new(secret, hmac.new(initNonce, respNonce, hashlib.sha256).digest(), hashlib.sha256).digest())
 
+def _dhCall(func, args): # in a worker process, return (ok, value) so that the waiter is resumed even on failure
+    try: return (True, func(*args))
+    except Exception, e: return (False, repr(e))
+
+class DHWorkers(object):
+    '''Diffie-Hellman exponentiations in a pool of worker processes, so that the handshakes do not stall the event loop.
+    A pool of ready (x, y) keypairs of _beginDH() is kept topped up, and the shared secret of _endDH() is computed while
+    the handshake task waits. The worker callbacks run in a thread of the multiprocessing pool, hence they hand over the
+    results to the event loop with a self-pipe that the dispatch task reads. Both keypair() and secret() must be yielded.
+    If a job fails, is lost with its worker, or does not complete within timeout seconds, or the pool is closed, the value
+    is computed in the event loop instead.'''
+    def __init__(self, processes=None, size=32, timeout=5):
+        self.size, self.timeout, self.results, self.keypairs, self.waiting = size, timeout, collections.deque(), multitask.Queue(), []
+        self.pool, (self._rfd, self._wfd) = multiprocessing.Pool(processes), os.pipe()
+        for i in xrange(size): self._submit(_beginDH, (), self.keypairs)
+        multitask.add(self.dispatch())
+
+    def close(self): # the dispatch task resumes the waiters and closes the pipe when it wakes up
+        if self.pool is not None:
+            self.pool.terminate(); self.pool = None
+            os.write(self._wfd, 'x')
+
+    def _submit(self, func, args, queue):
+        if self.pool is not None: self.pool.apply_async(_dhCall, (func, args), callback=lambda result: self._done(queue, result))
+
+    def _done(self, queue, result): # invoked in the result thread of the pool
+        self.results.append((queue, result))
+        try: os.write(self._wfd, 'x')
+        except OSError: pass # closed
+
+    def dispatch(self):
+        try:
+            while self.pool is not None:
+                yield multitask.read(self._rfd, 4096)
+                while self.results:
+                    queue, result = self.results.popleft()
+                    yield queue.put(result)
+            for queue in self.waiting[:]: # the jobs in flight were terminated
+                yield queue.put((False, 'closed'))
+        finally:
+            os.close(self._rfd); os.close(self._wfd)
+
+    def _wait(self, queue): # return (ok, value) from queue, or (False, None) on timeout
+        if self.pool is None:
+            raise StopIteration((False, None))
+        self.waiting.append(queue)
+        try: result = yield queue.get(timeout=self.timeout)
+        except multitask.Timeout: result = (False, None)
+        finally: self.waiting.remove(queue)
+        raise StopIteration(result)
+
+    def keypair(self):
+        '''Return a ready (x, y) keypair from the pool, and start computing its replacement.'''
+        ok, result = yield self._wait(self.keypairs)
+        self._submit(_beginDH, (), self.keypairs) # also replaces a lost job after a timeout
+        if not ok:
+            if _debug: print 'DHWorkers.keypair() failed %r, computing in the event loop'%(result,)
+            result = _beginDH()
+        raise StopIteration(result)
+
+    def secret(self, x, y):
+        '''Return _endDH(x, y) computed in a worker process.'''
+        queue = multitask.Queue()
+        self._submit(_endDH, (x, y), queue)
+        ok, result = yield self._wait(queue)
+        if not ok:
+            if _debug: print 'DHWorkers.secret() failed %r, computing in the event loop'%(result,)
+            result = _endDH(x, y)
+        raise StopIteration(result)
+
 
 #--------------------------------------
 # DATA: Peer, Peers, Group, Client, Target, Cookie
@@ -685,26 +782,48 @@ class Peer(Client):
 
 
 class Peers(list):
-    '''List of Peer objects kept sorted by ping property. Must use add() method to add to the list.'''
+    '''List of Peer objects kept sorted by ping property, highest first, and a new peer before the ones of the same ping.
+    Must use add() and remove() methods to change the list. The sort key (-ping, sequence) of each peer is kept in a parallel
+    list to find the position with bisect, and indexed by the peer id to test the membership.'''
     def __init__(self):
-        list.__init__()
+        list.__init__(self)
+        self._keys, self._index, self._sequence = [], {}, 0
     def close(self):
-        self[:] = []
+        self[:] = self._keys[:] = []
+        self._index.clear()
+    def __contains__(self, peer):
+        return (peer.id if isinstance(peer, Entity) else peer) in self._index
     def add(self, peer):
-        if peer not in self:
-            for index, p in enumerate(self):
-                if peer.ping >= p.ping:
-                    break
+        if peer.id not in self._index:
+            self._sequence -= 1
+            key = self._index[peer.id] = (-peer.ping, self._sequence)
+            index = bisect.bisect_left(self._keys, key)
+            self._keys.insert(index, key)
             self.insert(index, peer)
-    def best(self, asker, max_count=6):
-        return ([x for x in self if not _isLocal(x.address) and x != asker] + [x for x in self if _isLocal(x.address) and x != asker])[:max_count]
+    def remove(self, peer):
+        key = self._index.pop(peer.id, None)
+        if key is not None:
+            index = bisect.bisect_left(self._keys, key)
+            del self._keys[index], self[index]
+    def best(self, asker, max_count=6): # the first max_count peers other than asker, with the local ones last
+        result, local = [], []
+        for x in self:
+            if x != asker:
+                if not _isLocal(x.address):
+                    result.append(x)
+                    if len(result) == max_count: break
+                elif len(local) < max_count: local.append(x)
+        return (result + local)[:max_count]
 
 class Group(object):
     '''A Group has a unique id and a list of peers.'''
     def __init__(self, id):
         self.id, self.peers = id, Peers()
     def __cmp__(self, other):
-        return cmp(self.id, other.id if isinstance(other, group) else other)
+        return cmp(self.id, other.id if isinstance(other, Group) else other)
+    def close(self):
+        for peer in self.peers: peer.groups.remove(self)
+        self.peers.close()
     def add(self, peer):
         if peer not in self.peers:
             peer.groups.append(self)
@@ -733,16 +852,16 @@ class Target(Entity):
         #    self.DH = None
 
 class Cookie(object):
-    def __init__(self, value):
-        self.queryUrl, self.id, self.createdTs = '', 0, time.time()
-        self.target = self.nonce = self.DH = None
+    def __init__(self, value, DH=None): # DH is an (x, y) keypair, or None to compute it for queryUrl
+        self.queryUrl, self.id, self.createdTs, self.pending = '', 0, time.time(), False
+        self.target = self.nonce = self.DH = self._timer = None
         if isinstance(value, Target): # target
             self.target, self.DH = value, value.DH
             if _debug: print '   create cookie with target %r'%(value,)
             self.nonce = '\x03\x1A\x00\x00\x02\x1E\x00\x41\x0E' + _random(64) # len is 9+64=73
         else: # queryUrl
             self.queryUrl = value
-            self.DH = _beginDH()
+            self.DH = DH or _beginDH()
             if _debug: print '   create cookie with queryUrl %r'%(value,)
             self.nonce = '\x03\x1A\x00\x00\x02\x1E\x00\x81\x02\x0D\x02' + _int2bin(self.DH[1], 128) # len is 11+key
                 
@@ -755,9 +874,9 @@ class Cookie(object):
     def obsolete(self):
         return (time.time() - self.createdTs) >= 120 # two minutes elapsed
     
-    def computeKeys(self, initKey, initNonce): # returns (dkey, ekey)
+    def computeKeys(self, initKey, initNonce, secret=None): # returns (dkey, ekey). secret is _endDH() if already computed
         assert len(initKey) == 128
-        sharedSecret = _int2bin(_endDH(self.DH[0], _bin2int(initKey)), len(initKey))
+        sharedSecret = _int2bin(secret if secret is not None else _endDH(self.DH[0], _bin2int(initKey)), len(initKey))
         assert len(sharedSecret) == 128
         # return _asymetricKeys(sharedSecret, initNonce, self.nonce)
         dkey, ekey = _asymetricKeys(sharedSecret, initNonce, self.nonce)
@@ -1352,7 +1471,9 @@ class FlowWriter(object):
             if msg.fragments:
                 deltaNack += len(msg.fragments)
                 continue
-            self._trigger.start()
+            if not self._trigger.running:
+                self._trigger.start()
+                self.session.wakeup() # to repeat the message if not acknowledged
             msg.startStage = self.stage
             fragments = 0
             available, reader = msg.reader()
@@ -1553,6 +1674,9 @@ class Trigger(object):
             self._running = True
     def stop(self):
         self._running = False
+    @property
+    def running(self):
+        return self._running
     def dispatch(self):
         if not self._running:
             return False
@@ -1578,7 +1702,8 @@ class Session(object):
         self._target = self._lastFlowWriter = None
         self._flows, self._flowWriters, self._handshakeAttempts = {}, {}, {}
         self._writer = PacketWriter()
-        self._recvTs = time.time() # TODO: is this correct?
+        self._recvTs = self._timeManaged = time.time() # TODO: is this correct?
+        self._timer = None # of FlashServer.timers
     
     def __repr__(self):
         return '<Session id=%r farId=%r peer=%r />'%(self.id, self.farId, self.peer)
@@ -1598,8 +1723,22 @@ class Session(object):
             self.server.onDisconnect(self.peer)
             self.server.count -= 1
         self.died = self.failed = True
+        self.wakeup() # to be removed
+    
+    def deadline(self):
+        '''Return the time when manage() is due. It is every manage period while failing, repeating messages or keeping alive,
+        and else when the keepalive starts 2 min after the last message received. A dead session is due now.'''
+        if self.died:
+            return time.time()
+        if self.failed or self._recvTs <= time.time() - 120 or [x for x in self._flowWriters.itervalues() if x.consumed or x._trigger.running]:
+            return self._timeManaged + self.server.period
+        return self._recvTs + 120
+    
+    def wakeup(self): # reschedule after a change that may need manage() earlier
+        self.server.schedule(self)
     
     def manage(self):
+        self._timeManaged = time.time()
         if self.died:
             return
         if self.failed:
@@ -1639,6 +1778,7 @@ class Session(object):
         if self.failed:
             return
         self.failed = True
+        self.wakeup() # to repeat the fail signal
         if self.peer.state != Peer.NONE:
             self.server.onFailed(self.peer, error)
         for flowWriter in self._flowWriters.itervalues():
@@ -1715,6 +1855,7 @@ class Session(object):
             self._writer.write(struct.pack('>BH', type, len(data)) + data)
 
     def handle(self, data, sender):
+        if sender != self.peer.address: self.server.moveSession(self, sender)
         self.peer.address = sender
         if self._target:
             self._target.address = sender
@@ -1880,19 +2021,15 @@ class Handshake(Session):
     
     def close(self):
         for item in self._cookies.values():
+            self.server.timers.cancel(item._timer)
             item.close()
         self._cookies.clear()
-        
-    def manage(self):
-        toRemove = [cookieId for cookieId, cookie in self._cookies.iteritems() if cookie.obsolete]
-        for cookieId in toRemove:
-            del self._cookies[cookieId]
 
     def commitCookie(self, session):
         session.checked = True
         toRemove = [cookieId for cookieId, cookie in self._cookies.iteritems() if cookie.id == session.id]
         for cookieId in toRemove:
-            del self._cookies[cookieId]
+            self.server.timers.cancel(self._cookies.pop(cookieId)._timer)
         if not toRemove:
             if _debug: print 'Handshake.commitCookie() cookie for session[%r] not found'%(session.id,)
 
@@ -1913,6 +2050,11 @@ class Handshake(Session):
         respId, response = self._handshake(id, payload)
         if respId == 0:
             return
+        self._respond(respId, response)
+
+    def _respond(self, respId, response, farId=None, address=None): # farId and address of the peer, if not the current ones
+        if farId is not None: self.farId = farId
+        if address is not None: self.peer.address = address
         response = struct.pack('>BH', respId, len(response)) + response
         self._writer.write(response)
         self.flush(self.SYMMETRIC_ENCODING | self.WITHOUT_ECHO_TIME)
@@ -1930,6 +2072,9 @@ class Handshake(Session):
                 respId, resp = self.server.handshakeP2P(tag, self.peer.address, epd)
                 return (respId, response+resp)
             elif type == 0x0a:
+                if self.server.dh is not None: # respond when a keypair is ready
+                    multitask.add(self._createCookieTask(response, epd, self.peer.address))
+                    return (0, '')
                 cookie = self._createCookie(Cookie(epd))
                 cert = self._certificate
                 if _debug: print '    handshake response type=0x%02x\n     tag=%s\n     cookie=%s\n     cert=%s'%(0x70, truncate(tag), truncate(cookie), truncate(cert))
@@ -1950,6 +2095,12 @@ class Handshake(Session):
                 publicKey = key1[-128:]
                 key2, payload = _unpackString(payload)
                 if _debug: print '     far-id=%r\n     cookie-id=%s\n     client-cert=%s\n     client-nonce=%s'%(self.farId, truncate(cookieId), truncate(key1), truncate(key2))
+                if cookie.pending: # retransmission while the keys are computed
+                    return (0, '')
+                if self.server.dh is not None and cookie.DH: # respond when the shared secret is ready
+                    cookie.pending = True
+                    multitask.add(self._computeKeysTask(cookie, self.farId, self.peer.dup(), publicKey, key2))
+                    return (0, '')
                 dkey, ekey = cookie.computeKeys(publicKey, key2)
                 self.peer.path, self.peer.parameters = _url2pathquery(cookie.queryUrl)
                 result = self.server.createSession(self.farId, self.peer, dkey, ekey, cookie)
@@ -1964,16 +2115,33 @@ class Handshake(Session):
             raise ValueError('unknown handshake packet id 0x%02x'%(id,))
     
     def finishHandshake(self, cookie):
-        respId, response = 0x78, str(cookie)
         if _debug: print '   handshake continue response type=0x%02x\n     id=%r\n     server-nonce=%s'%(0x78, cookie.id, truncate(cookie.nonce))
-        response = struct.pack('>BH', respId, len(response)) + response
-        self._writer.write(response)
-        self.flush(self.SYMMETRIC_ENCODING | self.WITHOUT_ECHO_TIME)
-        self.farId = 0
+        self._respond(0x78, str(cookie))
+
+    def _createCookieTask(self, response, epd, address):
+        DH = yield self.server.dh.keypair()
+        cookie, cert = self._createCookie(Cookie(epd, DH)), self._certificate
+        if _debug: print '    handshake response type=0x%02x\n     cookie=%s\n     cert=%s'%(0x70, truncate(cookie), truncate(cert))
+        self._respond(0x70, response + cookie + cert, 0, address)
+
+    def _computeKeysTask(self, cookie, farId, peer, publicKey, initNonce):
+        try:
+            secret = yield self.server.dh.secret(cookie.DH[0], _bin2int(publicKey))
+            dkey, ekey = cookie.computeKeys(publicKey, initNonce, secret)
+            peer.path, peer.parameters = _url2pathquery(cookie.queryUrl)
+            result = self.server.createSession(farId, peer, dkey, ekey, cookie)
+            if result < 0:
+                return
+            cookie.id = result
+            if _debug: print '   handshake response type=0x%02x\n     id=%r\n     server-nonce=%s'%(0x78, cookie.id, truncate(cookie.nonce))
+            self._respond(0x78, str(cookie), farId, peer.address)
+        finally:
+            cookie.pending = False
         
     def _createCookie(self, cookie):
         cookieId = _random(64)
         self._cookies[cookieId] = cookie
+        cookie._timer = self.server.timers.push(cookie.createdTs + 120, lambda: self._cookies.pop(cookieId, None)) # when obsolete
         return _packString(cookieId, 8)
         
 class Middle(Session):
@@ -2156,6 +2324,7 @@ class Middle(Session):
         #    self._pending.append((data, sender))
         #    return
             
+        if sender != self.peer.address: self.server.moveSession(self, sender)
         self.peer.address = sender
         if self._target:
             self._target.address = sender
@@ -2326,20 +2495,25 @@ class Middle(Session):
 #--------------------------------------
 # CONTROL: FlashServer
 #--------------------------------------
-        
+
 class FlashServer(rtmp.FlashServer):
     '''A combined RTMFP and RTMP server.'''
     def __init__(self):
         rtmp.FlashServer.__init__(self)
         self._handshake = Handshake(self)
-        self.sockUdp, self.sessions, self._nextId = None, {0: self._handshake}, 0
-        self.streams, self.count, self.keep_alive_server, self.keep_alive_peer, self._groups, self._timeLastManage = Streams(), 0, 15, 10, [], 0 # from handler
+        self.sockUdp, self.sessions, self._nextId, self.dh = None, {0: self._handshake}, 0, None
+        self._sessionsByAddress, self._sessionsByPeerId = {}, {} # indexes of self.sessions other than the handshake
+        self.streams, self.count, self.keep_alive_server, self.keep_alive_peer, self._groups, self.freq_manage = Streams(), 0, 15, 10, {}, 2 # from handler
+        self.timers = multitask._TimerHeap() # deadlines of the sessions and cookies, with the funcs invoked by manager
+        self._groupsLimit = 16 # number of groups to drop the empty ones
     
     def close(self):
-        [x.close() for x in self._groups] # from handler
-        self._groups[:] = []
+        [x.close() for x in self._groups.itervalues()] # from handler
+        self._groups.clear()
 
     def start(self, options):
+        if options.dh_workers and not self.dh: # before opening the sockets, which the forked workers would inherit
+            self.dh = DHWorkers(options.dh_workers, options.dh_pool)
         if not options.no_rtmp:
             rtmp.FlashServer.start(self, options.host, options.port)
         self.cirrus, self.middle, self.freq_manage, self.keep_alive_server, self.keep_alive_peer = options.cirrus, options.middle, options.freq_manage, options.keep_alive_server, options.keep_alive_peer
@@ -2349,12 +2523,16 @@ class FlashServer(rtmp.FlashServer):
             sock.bind((options.host, options.port))
             if _debug: print 'FlashServer.start() listening udp on ', sock.getsockname()
             multitask.add(self.serverudplistener())
+            multitask.add(self.manager())
             
     def stop(self):
         rtmp.FlashServer.stop(self)
         self._handshake.close()
         for session in self.sessions.itervalues(): session.close()
         self.sessions.clear()
+        self._sessionsByAddress.clear(); self._sessionsByPeerId.clear()
+        if self.dh:
+            self.dh.close(); self.dh = None
         if self.sockUdp:
             try: self.sockUdp.close(); self.sockUdp = None
             except: pass
@@ -2362,7 +2540,6 @@ class FlashServer(rtmp.FlashServer):
     def serverudplistener(self, max_size=2048):
         try:
             while True:
-                self.manage()
                 data, remote = yield multitask.recvfrom(self.sockUdp, max_size)
 #                if _debug: print 'socket.recvfrom %r\n    data=%s'%(remote, truncate(data))
                 if _debug: print '<= %s:%d [%d]'%(remote[0], remote[1], len(data))
@@ -2408,16 +2585,30 @@ class FlashServer(rtmp.FlashServer):
         return self.sockUdp.sendto(data, remote)
         
     def group(self, id):
-        for group in self._groups:
-            if group.operator == id:
-                return group
-        newGroups = [group for group in self._groups if len(group.peers) > 0]
-        if len(self._groups) != len(newGroups):
-            self._groups[:] = newGroups
-        group = Group(id)
-        self._groups.append(group)
+        group = self._groups.get(id, None)
+        if group is None:
+            if len(self._groups) >= self._groupsLimit: # drop the empty groups once the number of groups has doubled
+                for groupId in [groupId for groupId, group in self._groups.iteritems() if not group.peers]: del self._groups[groupId]
+                self._groupsLimit = max(16, 2*len(self._groups))
+            group = self._groups[id] = Group(id)
         return group
 
+    def addSession(self, session):
+        self.sessions[session.id] = session
+        self._sessionsByAddress[session.peer.address] = session
+        self._sessionsByPeerId[session.peer.id] = session
+        self.schedule(session)
+
+    def removeSession(self, session):
+        del self.sessions[session.id]
+        self.timers.cancel(session._timer); session._timer = None
+        for index, key in ((self._sessionsByAddress, session.peer.address), (self._sessionsByPeerId, session.peer.id)):
+            if index.get(key, None) is session: del index[key]
+
+    def moveSession(self, session, address): # update the index when the address of the session's peer changes
+        if self._sessionsByAddress.get(session.peer.address, None) is session: del self._sessionsByAddress[session.peer.address]
+        if self.sessions.get(session.id, None) is session: self._sessionsByAddress[address] = session
+
     def createSession(self, farId, peer, dkey, ekey, cookie):
         while self._nextId in self.sessions: self._nextId += 1
         target = None
@@ -2435,21 +2626,20 @@ class FlashServer(rtmp.FlashServer):
             if _debug: print '   created %r'%(session,)
             if _debug: print '   waiting for handshake completion from middle'
             session._handshakeCookie = cookie
-            self.sessions[session.id] = session
+            self.addSession(session)
             cookie.id = session.id
             return -1
         else:
             session = Session(self, self._nextId, farId, peer.dup(), dkey, ekey)
             session._target = cookie.target
             if _debug: print '   created %r'%(session,)
-        self.sessions[session.id] = session
+        self.addSession(session)
         return session.id
     
     def handshakeP2P(self, tag, address, peerIdWanted):
         # TODO: we need a better way to associate the session based on the far-id parameter?
-        found = [session for session in self.sessions.itervalues() if session.peer.address == address and session != self._handshake]
-        session = found and found[0] or None
-        sessionWanted = ([s for s in self.sessions.itervalues() if s.peer and s.peer.id == peerIdWanted] + [None])[0]
+        session = self._sessionsByAddress.get(address, None)
+        sessionWanted = self._sessionsByPeerId.get(peerIdWanted, None)
         if _debug: print '   p2p-handshake tag=%r address=%r peerIdWanted=%r found session.id=%r session wanted=%r'%(tag, address, peerIdWanted, session and session.id, sessionWanted and sessionWanted.id)
         # TODO: ignoring cirrus case
         if not sessionWanted:
@@ -2480,26 +2670,51 @@ class FlashServer(rtmp.FlashServer):
             response += _packAddress(addr, False)
         return (0x71, response)
     
-    def manage(self):
-        if self._timeLastManage > time.time() - 2:
-            #if self.middle:
-            #    for session in self.sessions.itervalues():
-            #        if session and isinstance(session, Middle):
-            #            session.manage()
+    @property
+    def period(self): # of managing the sessions that are failing, repeating messages or keeping alive
+        return self.freq_manage or 2
+
+    def schedule(self, session): # set the timer of the session to its deadline, unless it is due earlier
+        if session is self._handshake or self.sessions.get(session.id, None) is not session:
             return
-        self._timeLastManage = time.time()
-        self._handshake.manage()
-        toDelete = []
-        for sessionId, session in self.sessions.iteritems():
-            session.manage()
-            if sessionId != 0 and session.died:
-                if _debug: print 'FlashServer.manage() note: session %u died'%(session.id,)
-                toDelete.append(sessionId)
-        for sessionId in toDelete:
+        deadline, timer = session.deadline(), session._timer
+        if timer is not None and timer[2] is not None and timer[0] <= deadline:
+            return
+        self.timers.cancel(timer)
+        session._timer = self.timers.push(deadline, lambda: self._manageSession(session))
+
+    def _manageSession(self, session): # when the timer of the session expires
+        session._timer = None
+        if self.sessions.get(session.id, None) is not session: # removed meanwhile
+            return
+        if not session.died and session.deadline() > time.time(): # received a message meanwhile
+            return self.schedule(session)
+        try: session.manage()
+        except: # retry in the next manage period, and let the manager report it
+            session._timer = self.timers.push(time.time() + self.period, lambda: self._manageSession(session))
+            raise
+        if session.died:
+            if _debug: print 'FlashServer.manage() note: session %u died'%(session.id,)
             session.close()
-            del self.sessions[sessionId]
-        if self._timeLastManage < time.time() - 0.020: # more than 20ms
-            if _debug: print 'FlashServer.manage() warning: process management lasted more than 20ms: %d'%(time.time() - self._timeLastManage,)
+            self.removeSession(session)
+        else:
+            self.schedule(session)
+
+    def manager(self):
+        '''Invoke the expired timers of the sessions and cookies. It sleeps until the next deadline, but at most for the manage
+        period, as an earlier deadline may be scheduled meanwhile.'''
+        try:
+            while self.sockUdp:
+                start = time.time()
+                for func in self.timers.expired(start):
+                    try: func()
+                    except Exception, e:
+                        print 'FlashServer.manager() exception', e
+                        if _debug: traceback.print_exc()
+                if _debug and time.time() - start > 0.020: print 'FlashServer.manager() warning: process management lasted more than 20ms: %.3f s'%(time.time() - start,)
+                first = self.timers.first()
+                yield multitask.sleep(max(0, min(self.period, first - time.time() if first is not None else self.period)))
+        except GeneratorExit: pass
     
     # callbacks from the session
     def onConnect(self, client, flowWriter): # return True to accept the session from this client/peer
@@ -2541,6 +2756,59 @@ class FlashServer(rtmp.FlashServer):
         pass
 
 
+def _benchHandshake(count=200, workers=2):
+    '''Measure the rate of RTMFP handshakes of a reconnect storm, with the Diffie-Hellman keys computed in the event loop
+    and in worker processes, and the time the event loop spent on each handshake packet.
+      $ python -c "import rtmfp; rtmfp._benchHandshake()"
+    '''
+    clients = [_beginDH() for i in xrange(count)] # of the clients, computed before measuring
+    nonces = [_random(64) for i in xrange(count)]
+    def packet(id, payload, encoder): # handshake packet from a client
+        return _packId(_encode(encoder, '\x00'*6 + '\x0b' + struct.pack('>HBH', 0, id, len(payload)) + payload), 0)
+    def response(data, decoder): # (id, payload) of a handshake response to a client
+        data = _decode(decoder, data)
+        id, size = struct.unpack('>BH', data[9:12])
+        return id, data[12:12+size]
+    def storm(server, sent, stats):
+        handshake, encoder, decoder, tag = server._handshake, AESEncrypt(_key), AESDecrypt(_key), '\x00'*16
+        def handle(data, address):
+            start = time.time(); handshake.handle(data, address); stats['busy'].append(time.time() - start)
+        for i in xrange(count):
+            epd = '\x0a' + 'rtmfp://localhost/bench'
+            handle(packet(0x30, '\x00' + chr(len(epd)) + epd + tag, encoder), ('127.0.0.1', 10000+i))
+            yield # let the responses in
+        while stats['done'] < count:
+            while sent:
+                data, address = sent.pop(0)
+                i, (id, payload) = address[1] - 10000, response(data, decoder)
+                if id == 0x70: # send the public key and nonce to get the session
+                    tag, payload = _unpackString(payload, 8)
+                    cookieId, payload = _unpackString(payload, 8)
+                    key1 = '\x1d\x02' + _int2bin(clients[i][1], 128)
+                    handle(packet(0x38, struct.pack('>I', i+1) + _packString(cookieId) + _packString(key1) + _packString(nonces[i]), encoder), address)
+                elif id == 0x78:
+                    stats['done'] += 1
+                    stats[i] = (struct.unpack('>I', payload[:4])[0], _unpackString(payload[4:])[0]) # session id, server nonce
+            yield multitask.sleep(0.001)
+        stats['elapsed'] = time.time() - stats['start']
+        if server.dh: server.dh.close(); server.dh = None
+    for n in sorted(set((0, workers))):
+        server, sent, stats = FlashServer(), [], {'busy': [], 'done': 0, 'start': time.time()}
+        server.middle, server.send = False, lambda data, remote: sent.append((data, remote)) or len(data)
+        if n:
+            server.dh = DHWorkers(n, 32)
+            while len(server.dh.keypairs) < 32: multitask.get_default_task_manager().run_next(0.01) # pool is ready before the storm
+            stats['start'] = time.time()
+        multitask.add(storm(server, sent, stats))
+        multitask.run()
+        assert len(server.sessions) == count + 1
+        for i in xrange(0, count, 10): # both sides have the same keys
+            sessionId, nonce = stats[i]
+            dkey, ekey = _asymetricKeys(_int2bin(_endDH(clients[i][0], _bin2int(nonce[11:])), 128), nonces[i], nonce)
+            assert server.sessions[sessionId]._aesDecrypt.key == dkey[:16]
+        busy = sorted(stats['busy'])
+        print '%s: %d handshakes in %.3f s, %d handshakes/s, event loop busy per packet %.2f ms median, %.2f ms 90th percentile'%('%d workers'%(n,) if n else 'inline', count, stats['elapsed'], count/stats['elapsed'], busy[len(busy)/2]*1000, busy[len(busy)*9/10]*1000)
+
 #--------------------------------------
 # MAIN
 #--------------------------------------
@@ -2559,6 +2827,8 @@ if __name__ == '__main__':
     group.add_option('',   '--freq-manage', dest='freq_manage', type='int', default=2, help='frequency manage in seconds. Default 2')
     group.add_option('',   '--keep-alive-server', dest='keep_alive_server', default=15, type='int', help='Keep alive interval with server. Default 15')
     group.add_option('',   '--keep-alive-peer', dest='keep_alive_peer', default=10, type='int', help='Keep alive interval with peer. Default 10')
+    group.add_option('',   '--dh-workers', dest='dh_workers', default=0, type='int', help='Number of processes that compute the Diffie-Hellman keys of the handshakes. Default 0 to compute them in the event loop')
+    group.add_option('',   '--dh-pool', dest='dh_pool', default=32, type='int', help='Number of Diffie-Hellman keypairs computed in advance. Default 32')
     group.add_option('',   '--no-rtmp', dest='no_rtmp', default=False, action='store_true', help='Disable RTMP over TCP. Default is to also keep RTMP over TCP')
     parser.add_option_group(group)
     (options, args) = parser.parse_args()
@@ -61,7 +61,7 @@ throw an exception and display the error message.
 
 '''
 
-import os, sys, time, struct, socket, traceback, multitask, amf, hashlib, hmac, random
+import os, sys, time, struct, socket, traceback, collections, bisect, mmap, array, threading, Queue, multitask, amf, hashlib, hmac, random
 
 _debug = False
 
@@ -76,6 +76,7 @@ class SockStream(object):
     def __init__(self, sock):
         self.sock, self.buffer = sock, ''
         self.bytesWritten = self.bytesRead = 0
+        sock.setblocking(0) # send/recv only after select, so that a large send returns partial count instead of blocking
     
     def close(self):
         self.sock.close()
@@ -97,15 +98,109 @@ class SockStream(object):
         
     def unread(self, data):
         self.buffer = data + self.buffer
+    
+    def available(self):
+        '''Return the number of bytes received but not yet read.'''
+        return len(self.buffer)
+    
+    def fill(self, count):
+        '''Generator to receive from the socket until at least count bytes are available.'''
+        try:
+            while len(self.buffer) < count:
+                if _debug: print 'socket.read[%d] calling recv()'%(count,)
+                data = (yield multitask.recv(self.sock, 4096)) # read more from socket
+                if not data: raise ConnectionClosed
+                if _debug: print 'socket.read[%d] %r'%(len(data), truncate(data))
+                self.bytesRead += len(data)
+                self.buffer += data
+        except GeneratorExit: raise # closed by the task manager when the player shuts down
+        except: raise ConnectionClosed # anything else is treated as connection closed.
+    
+    def peek(self):
+        '''Return (buf, start, end) such that buf[start:end] are the available bytes. Used with skip() to parse in place.'''
+        return (self.buffer, 0, len(self.buffer))
+    
+    def skip(self, count):
+        '''Discard count bytes that were parsed in place after peek().'''
+        self.buffer = self.buffer[count:]
             
     def write(self, data):
-        while len(data) > 0: # write in 4K chunks each time
-            chunk, data = data[:4096], data[4096:]
-            self.bytesWritten += len(chunk)
-            if _debug: print 'socket.write[%d] %r'%(len(chunk), truncate(chunk))
-            try: yield multitask.send(self.sock, chunk)
+        '''Generator to send all of data, resuming from the sent offset after a partial send.'''
+        offset = 0
+        while offset < len(data):
+            try: sent = yield multitask.send(self.sock, buffer(data, offset))
             except: raise ConnectionClosed
-                                
+            if _debug: print 'socket.write[%d] %r'%(sent, truncate(data[offset:offset+sent]))
+            offset += sent; self.bytesWritten += sent
+
+class BufferedSockStream(SockStream):
+    '''A SockStream that receives using recv_into in a preallocated bytearray instead of growing a str buffer. The unread bytes
+    are between the start and end offsets, hence read(count) copies out only count bytes, readView(count) returns a memoryview
+    without any copy, and unread(data) moves the start offset back instead of prepending. The unread bytes are moved to the
+    front (or the buffer is grown) only when there is no room left at the end for the next recv_into.'''
+    BUFFER_SIZE, MIN_RECV_SIZE = 65536, 4096
+    def __init__(self, sock, size=None):
+        SockStream.__init__(self, sock)
+        self.data, self.start, self.end = bytearray(size or self.BUFFER_SIZE), 0, 0
+        self.view = memoryview(self.data)
+
+    def available(self):
+        '''Return the number of bytes received but not yet read.'''
+        return self.end - self.start
+
+    def _reserve(self, count):
+        '''Make room for at least count bytes after the end offset, by moving unread bytes to front or growing the buffer.'''
+        size = self.end - self.start
+        if len(self.data) - self.end >= count: return
+        if len(self.data) - size < count: # grow; any view returned earlier keeps referring to the old buffer
+            data = bytearray(max(2*len(self.data), size + count))
+            data[:size] = self.view[self.start:self.end]
+            self.data, self.view = data, memoryview(data)
+        elif size > 0:
+            self.view[:size] = self.view[self.start:self.end]
+        self.start, self.end = 0, size
+
+    def fill(self, count):
+        '''Generator to receive from the socket until at least count bytes are available.'''
+        try:
+            while self.end - self.start < count:
+                self._reserve(max(count - (self.end - self.start), self.MIN_RECV_SIZE))
+                if _debug: print 'socket.read[%d] calling recv_into()'%(count,)
+                size = (yield multitask.recv_into(self.sock, self.view[self.end:]))
+                if not size: raise ConnectionClosed
+                if _debug: print 'socket.read[%d] %r'%(size, truncate(self.view[self.end:self.end+size].tobytes()))
+                self.bytesRead += size
+                self.end += size
+        except: raise ConnectionClosed # anything else is treated as connection closed.
+
+    def read(self, count):
+        if self.end - self.start < count: yield self.fill(count)
+        data, self.start = self.view[self.start:self.start+count].tobytes(), self.start + count
+        raise StopIteration(data)
+
+    def peek(self):
+        return (buffer(self.data), self.start, self.end) # buffer, unlike bytearray, gives str on index and slice
+
+    def skip(self, count):
+        self.start += count
+
+    def readView(self, count):
+        '''Same as read but returns a memoryview of the buffer, which is valid only until the next read, fill or unread.'''
+        if self.end - self.start < count: yield self.fill(count)
+        data, self.start = self.view[self.start:self.start+count], self.start + count
+        raise StopIteration(data)
+
+    def unread(self, data):
+        count = len(data)
+        if count <= self.start: # usually the data was just read, so it fits before the start offset
+            self.start -= count
+            self.view[self.start:self.start+count] = data
+        else: # no room before start, hence put the data and then the unread bytes at front
+            rest = self.view[self.start:self.end].tobytes()
+            self.start = self.end = 0
+            self._reserve(count + len(rest))
+            self.view[:count], self.view[count:count+len(rest)] = data, rest
+            self.end = count + len(rest)
 
 '''
 NOTE: Here is a part of the documentation to understand how the Chunks' headers work.
@@ -247,19 +342,56 @@ class Message(object):
     
     def dup(self):
         return Message(self.header.dup(), self.data[:])
+
+class Frame(object):
+    '''The payload of a message that is sent to many clients, e.g., live media fanned out to players. The chunked wire bytes are
+    built once for each chunk size and first chunk header, and the same string is shared by all the clients that have the same
+    chunking state. A Message refers to it using the frame attribute, and the frame is used only if message.data is frame.data.'''
+    def __init__(self, data):
+        self.data, self.chunks = data, {}
+    
+    def toBytes(self, hdr, control, chunkSize):
+        first = hdr.toBytes(control) # also identifies the channel, hence the separator header
+        key = (chunkSize, first)
+        if key not in self.chunks: self.chunks[key] = Protocol.chunk(hdr, control, self.data, chunkSize, first)
+        return self.chunks[key]
+                
+class WriteQueue(multitask.Queue):
+    '''The queue of messages to be written by a Protocol. It also tracks the total bytes and the enqueue time of the queued items,
+    where an item is a Message, a list of Message or None.'''
+    def __init__(self):
+        multitask.Queue.__init__(self)
+        self.bytes = 0
+    
+    def _put(self, item):
+        size = sum([m.size for m in item]) if isinstance(item, list) else item.size if item is not None else 0
+        self._queue.append((item, size, time.time())); self.bytes += size
+        
+    def _get(self):
+        item, size, ignore = self._queue.popleft(); self.bytes -= size
+        return item
+    
+    @property
+    def delay(self):
+        '''Seconds since the oldest queued item was enqueued.'''
+        return time.time() - self._queue[0][2] if self._queue else 0
                 
 class Protocol(object):
     PING_SIZE, DEFAULT_CHUNK_SIZE, HIGH_WRITE_CHUNK_SIZE, PROTOCOL_CHANNEL_ID = 1536, 128, 4096, 2 # constants
     READ_WIN_SIZE, WRITE_WIN_SIZE = 1000000L, 1073741824L
+    ZEROCOPY = False # use BufferedSockStream instead of SockStream for new connections
+    MAX_QUEUE_BYTES, MAX_QUEUE_DELAY = 0, 0 # default limits of writeQueue bytes and delay in seconds for live media, 0 to disable
     
     def __init__(self, sock):
-        self.stream = SockStream(sock)
+        self.stream = BufferedSockStream(sock) if self.ZEROCOPY else SockStream(sock)
         self.lastReadHeaders, self.incompletePackets, self.lastWriteHeaders = dict(), dict(), dict()
         self.readChunkSize = self.writeChunkSize = Protocol.DEFAULT_CHUNK_SIZE
         self.readWinSize0, self.readWinSize, self.writeWinSize0, self.writeWinSize = 0L, self.READ_WIN_SIZE, 0L, self.WRITE_WIN_SIZE
         self.nextChannelId = Protocol.PROTOCOL_CHANNEL_ID + 1
         self._time0 = time.time()
-        self.writeQueue = multitask.Queue()
+        self.writeQueue = WriteQueue()
+        self.bufferTimes = dict() # buffer length in millisec set by the client, indexed by stream id
+        self.maxQueueBytes, self.maxQueueDelay = self.MAX_QUEUE_BYTES, self.MAX_QUEUE_DELAY # may be changed per client, e.g., in onConnect
             
     @property
     def relativeTime(self):
@@ -283,6 +415,7 @@ class Protocol(object):
             type, data = struct.unpack('>H', msg.data[:2])[0], msg.data[2:]
             if type == 3: # client expects a response when it sends set buffer length
                 streamId, bufferTime = struct.unpack('>II', data)
+                self.bufferTimes[streamId] = bufferTime
                 response = Message()
                 response.time, response.type, response.data = self.relativeTime, Message.USER_CONTROL, struct.pack('>HI', 0, streamId)
                 yield self.writeMessage(response)
@@ -306,6 +439,13 @@ class Protocol(object):
                     
     def writeMessage(self, message):
         yield self.writeQueue.put(message)
+    
+    def congestion(self):
+        '''Return 0 if the writeQueue is within maxQueueBytes and maxQueueDelay, 1 if it exceeds any, or 2 if it exceeds twice.'''
+        level = 0
+        for value, limit in ((self.writeQueue.bytes, self.maxQueueBytes), (self.writeQueue.delay, self.maxQueueDelay)):
+            if limit and value > limit: level = max(level, 2 if value > 2*limit else 1)
+        return level
             
     def parseCrossDomainPolicyRequest(self):
         # read the request
@@ -380,7 +520,96 @@ class Protocol(object):
         return (''.join([chr(random.randint(0, 255)) for i in xrange(128)]), '')
         
     def parseMessages(self):
-        '''Parses complete messages until connection closed. Raises ConnectionLost exception.'''
+        '''Parses complete messages until connection closed. Raises ConnectionLost exception. All the complete chunks available
+        in the stream buffer are decoded in one loop, and it yields only to receive more data, to send ack or to handle a message.'''
+        CHANNEL_MASK, FULL, MESSAGE, TIME, SEPARATOR = 0x3F, Header.FULL, Header.MESSAGE, Header.TIME, Header.SEPARATOR
+        HEADER_SIZE = {FULL: 11, MESSAGE: 7, TIME: 3, SEPARATOR: 0} # excluding basic header and extended timestamp
+        stream, unpack_from, need = self.stream, struct.unpack_from, 1
+        while True:
+            yield stream.fill(need)
+            buf, pos, end = stream.peek()
+            first = pos
+            while True:
+                # the header and data of the chunk must be available before changing any state, otherwise wait for more.
+                if pos >= end: need = 1; break
+                hdrsize, offset = ord(buf[pos]), pos + 1
+                channel = hdrsize & CHANNEL_MASK
+                if channel == 0: # we need one more byte
+                    if end < offset + 1: need = offset + 1 - pos; break
+                    channel, offset = 64 + ord(buf[offset]), offset + 1
+                elif channel == 1: # we need two more bytes
+                    if end < offset + 2: need = offset + 2 - pos; break
+                    channel, offset = 64 + ord(buf[offset]) + 256 * ord(buf[offset+1]), offset + 2
+                
+                hdrtype = hdrsize & Header.MASK
+                header = self.lastReadHeaders.get(channel, None) if hdrtype != FULL else None
+                hdrend = offset + HEADER_SIZE[hdrtype]
+                if end < hdrend: need = hdrend - pos; break
+                if hdrtype < SEPARATOR: # time or delta has changed
+                    hi, lo = unpack_from('>BH', buf, offset); tm = (hi << 16) | lo
+                else:
+                    tm = header.time if header is not None else 0
+                if hdrtype < TIME: # size and type also changed
+                    hi, lo, type = unpack_from('>BHB', buf, offset+3); size = (hi << 16) | lo
+                else:
+                    size = header.size if header is not None else None
+                if tm == 0xFFFFFF: hdrend += 4 # extended timestamp
+                data = self.incompletePackets.get(channel, "") # are we continuing an incomplete packet?
+                count = min(size - len(data), self.readChunkSize) # how much more
+                if end < hdrend + count: need = hdrend + count - pos; break
+                
+                # complete chunk is available, update the header
+                if header is None:
+                    header = Header(channel)
+                    self.lastReadHeaders[channel] = header
+                if hdrtype < SEPARATOR: header.time = tm
+                if hdrtype < TIME: header.size, header.type = size, type
+                if hdrtype < MESSAGE: header.streamId, = unpack_from('<I', buf, offset+7)
+                if tm == 0xFFFFFF:
+                    header.extendedTime, = unpack_from('>I', buf, hdrend-4)
+                    if _debug: print 'extended time stamp', '%x'%(header.extendedTime,)
+                else:
+                    header.extendedTime = None
+                if hdrtype == FULL:
+                    header.currentTime = header.extendedTime or header.time
+                    header.hdrtype = hdrtype
+                elif hdrtype in (MESSAGE, TIME):
+                    header.hdrtype = hdrtype
+                
+                data += buf[hdrend:hdrend+count]
+                pos = hdrend + count
+                
+                # check if we need to send Ack
+                if self.readWinSize is not None and stream.bytesRead > (self.readWinSize0 + self.readWinSize):
+                    self.readWinSize0 = stream.bytesRead
+                    ack = Message()
+                    ack.time, ack.type, ack.data = self.relativeTime, Message.ACK, struct.pack('>L', self.readWinSize0)
+                    stream.skip(pos - first)
+                    yield self.writeMessage(ack)
+                    buf, pos, end = stream.peek()
+                    first = pos
+                
+                if len(data) < header.size: # we don't have all data
+                    self.incompletePackets[channel] = data
+                    continue
+                if hdrtype in (MESSAGE, TIME):
+                    header.currentTime = header.currentTime + (header.extendedTime or header.time)
+                elif hdrtype == SEPARATOR:
+                    if header.hdrtype in (MESSAGE, TIME):
+                        header.currentTime = header.currentTime + (header.extendedTime or header.time)
+                if channel in self.incompletePackets:
+                    del self.incompletePackets[channel]
+                    if _debug: print 'aggregated %r bytes message: readChunkSize(%r) x %r'%(len(data), self.readChunkSize, len(data) / self.readChunkSize)
+                
+                hdr = Header(channel=header.channel, time=header.currentTime, size=header.size, type=header.type, streamId=header.streamId)
+                stream.skip(pos - first) # may change the chunk size, so the remaining is parsed after this
+                yield self.parseMessage(Message(hdr, data))
+                buf, pos, end = stream.peek()
+                first = pos
+            stream.skip(pos - first)
+
+    def _parseMessagesByField(self):
+        '''Same as parseMessages but reads each header field from the stream separately. It is kept as reference for _benchParse.'''
         CHANNEL_MASK = 0x3F
         while True:
             hdrsize = ord((yield self.stream.read(1))[0])  # read header size byte
@@ -461,42 +690,41 @@ class Protocol(object):
                 hdr = Header(channel=header.channel, time=header.currentTime, size=header.size, type=header.type, streamId=header.streamId)
                 msg = Message(hdr, data)
 
-                if hdr.type == Message.AGGREGATE:
-                    ''' see http://code.google.com/p/red5/source/browse/java/server/trunk/src/org/red5/server/net/rtmp/event/Aggregate.java / getParts()
-                    '''
-                    if _debug: print 'Protocol.parseMessages aggregated msg=', msg 
-                    aggdata = data;
-                    while len(aggdata) > 0:
-                        '''
-                        type=1 byte
-                        size=3 bytes
-                        time=4 bytes
-                        streamId= 4 bytes
-                        data= size bytes
-                        backPointer=4 bytes, value == size
-                        '''
-                        subtype = ord(aggdata[0])
-                        subsize = struct.unpack('!I', '\x00' + aggdata[1:4])[0]
-                        subtime = struct.unpack('!I', aggdata[4:8])[0]
-                        substreamid = struct.unpack('<I', aggdata[8:12])[0]     
-                        subheader = Header(channel, time=subtime, size=subsize, type=subtype, streamId=substreamid) # TODO: set correct channel
-                        aggdata = aggdata[11:] # skip header       
-                        submsgdata = aggdata[:subsize] # get message data 
-                        submsg = Message(subheader, submsgdata) 
-                        
-                        yield self.parseMessage(submsg)
-                                        
-                        aggdata = aggdata[subsize:] # skip message data
-                    
-                        backpointer = struct.unpack('!I', aggdata[0:4])[0]
-                        if backpointer != subsize:
-                            print 'Warning aggregate submsg backpointer=%r != %r' % (backpointer, subsize)                          
-                        aggdata = aggdata[4:] # skip back pointer, go to next message
-                else:
-                    yield self.parseMessage(msg)
-                
+                yield self.parseMessage(msg)
 
     def parseMessage(self, msg):
+        if msg.type == Message.AGGREGATE:
+            ''' see http://code.google.com/p/red5/source/browse/java/server/trunk/src/org/red5/server/net/rtmp/event/Aggregate.java / getParts()
+            '''
+            if _debug: print 'Protocol.parseMessages aggregated msg=', msg 
+            aggdata, channel = msg.data, msg.header.channel
+            while len(aggdata) > 0:
+                '''
+                type=1 byte
+                size=3 bytes
+                time=4 bytes
+                streamId= 4 bytes
+                data= size bytes
+                backPointer=4 bytes, value == size
+                '''
+                subtype = ord(aggdata[0])
+                subsize = struct.unpack('!I', '\x00' + aggdata[1:4])[0]
+                subtime = struct.unpack('!I', aggdata[4:8])[0]
+                substreamid = struct.unpack('<I', aggdata[8:12])[0]     
+                subheader = Header(channel, time=subtime, size=subsize, type=subtype, streamId=substreamid) # TODO: set correct channel
+                aggdata = aggdata[11:] # skip header       
+                submsgdata = aggdata[:subsize] # get message data 
+                submsg = Message(subheader, submsgdata) 
+
+                yield self.parseMessage(submsg)
+
+                aggdata = aggdata[subsize:] # skip message data
+
+                backpointer = struct.unpack('!I', aggdata[0:4])[0]
+                if backpointer != subsize:
+                    print 'Warning aggregate submsg backpointer=%r != %r' % (backpointer, subsize)                          
+                aggdata = aggdata[4:] # skip back pointer, go to next message
+            return
         try:            
             if _debug: print 'Protocol.parseMessage msg=', msg            
             if msg.header.channel == Protocol.PROTOCOL_CHANNEL_ID:
@@ -506,55 +734,66 @@ class Protocol(object):
         except:
             if _debug: print 'Protocol.parseMessage exception', (traceback and traceback.print_exc() or None)
 
+    @staticmethod
+    def chunk(hdr, control, data, chunkSize, first=None):
+        '''Return the wire bytes of message data split in chunks of chunkSize, with the first chunk header of type control.'''
+        result, separator = [first or hdr.toBytes(control)], hdr.toBytes(Header.SEPARATOR)
+        for index in xrange(0, len(data), chunkSize):
+            if index: result.append(separator) # incomplete message continuation
+            result.append(data[index:index+chunkSize])
+        return ''.join(result)
+    
     def write(self):
-        '''Writes messages to stream'''
+        '''Writes messages to stream. All the messages that are ready in the writeQueue are chunked and sent together.'''
         while True:
-#            while self.writeQueue.empty(): (yield multitask.sleep(0.01))
-#            message = self.writeQueue.get() # TODO this should be used using multitask.Queue and remove previous wait.
-            message = yield self.writeQueue.get() # TODO this should be used using multitask.Queue and remove previous wait.
-            if _debug: print 'Protocol.write msg=', message
+            message, segments = (yield self.writeQueue.get()), []
+            while message is not None:
+                for m in (message if isinstance(message, list) else [message]): # a list is written together, e.g., GOP burst
+                    if _debug: print 'Protocol.write msg=', m
+                    segments.append(self.encode(m))
+                if self.writeQueue.empty(): break
+                message = yield self.writeQueue.get() # already available, hence no wait
+            if segments:
+                try:
+                    yield self.stream.write(''.join(segments))
+                except ConnectionClosed:
+                    yield self.connectionClosed()
+                except:
+                    print traceback.print_exc()
             if message is None: 
                 try: self.stream.close()  # just in case TCP socket is not closed, close it.
                 except: pass
                 break
-            
-            # get the header stored for the stream
-            if self.lastWriteHeaders.has_key(message.streamId):
-                header = self.lastWriteHeaders[message.streamId]
-            else:
-                if self.nextChannelId <= Protocol.PROTOCOL_CHANNEL_ID: self.nextChannelId = Protocol.PROTOCOL_CHANNEL_ID+1
-                header, self.nextChannelId = Header(self.nextChannelId), self.nextChannelId + 1
-                self.lastWriteHeaders[message.streamId] = header
-            if message.type < Message.AUDIO:
-                header = Header(Protocol.PROTOCOL_CHANNEL_ID)
-               
-            # now figure out the header data bytes
-            if header.streamId != message.streamId or header.time == 0 or message.time <= header.time:
-                header.streamId, header.type, header.size, header.time, header.delta = message.streamId, message.type, message.size, message.time, message.time
-                control = Header.FULL
-            elif header.size != message.size or header.type != message.type:
-                header.type, header.size, header.time, header.delta = message.type, message.size, message.time, message.time-header.time
-                control = Header.MESSAGE
-            else:
-                header.time, header.delta = message.time, message.time-header.time
-                control = Header.TIME
-            
-            hdr = Header(channel=header.channel, time=header.delta if control in (Header.MESSAGE, Header.TIME) else header.time, size=header.size, type=header.type, streamId=header.streamId)
-            assert message.size == len(message.data)
-
-            data = ''
-            while len(message.data) > 0:
-                data += hdr.toBytes(control) # gather header bytes
-                count = min(self.writeChunkSize, len(message.data))
-                data += message.data[:count]
-                message.data = message.data[count:]
-                control = Header.SEPARATOR # incomplete message continuation
-            try:
-                yield self.stream.write(data)
-            except ConnectionClosed:
-                yield self.connectionClosed()
-            except:
-                print traceback.print_exc()
+    
+    def encode(self, message):
+        '''Return the chunked wire bytes of the message, and update the last written header state for its stream.'''
+        # get the header stored for the stream
+        if self.lastWriteHeaders.has_key(message.streamId):
+            header = self.lastWriteHeaders[message.streamId]
+        else:
+            if self.nextChannelId <= Protocol.PROTOCOL_CHANNEL_ID: self.nextChannelId = Protocol.PROTOCOL_CHANNEL_ID+1
+            header, self.nextChannelId = Header(self.nextChannelId), self.nextChannelId + 1
+            self.lastWriteHeaders[message.streamId] = header
+        if message.type < Message.AUDIO:
+            header = Header(Protocol.PROTOCOL_CHANNEL_ID)
+           
+        # now figure out the header data bytes
+        if header.streamId != message.streamId or header.time == 0 or message.time <= header.time:
+            header.streamId, header.type, header.size, header.time, header.delta = message.streamId, message.type, message.size, message.time, message.time
+            control = Header.FULL
+        elif header.size != message.size or header.type != message.type:
+            header.type, header.size, header.time, header.delta = message.type, message.size, message.time, message.time-header.time
+            control = Header.MESSAGE
+        else:
+            header.time, header.delta = message.time, message.time-header.time
+            control = Header.TIME
+        
+        hdr = Header(channel=header.channel, time=header.delta if control in (Header.MESSAGE, Header.TIME) else header.time, size=header.size, type=header.type, streamId=header.streamId)
+        assert message.size == len(message.data)
+
+        frame = getattr(message, 'frame', None)
+        if frame is not None and frame.data is message.data: return frame.toBytes(hdr, control, self.writeChunkSize) # shared by players
+        return Protocol.chunk(hdr, control, message.data, self.writeChunkSize)
 
 class Command(object):
     ''' Class for command / data messages'''
@@ -572,8 +811,16 @@ class Command(object):
         return self.args[index]
     
     @classmethod
-    def fromMessage(cls, message):
-        ''' initialize from a parsed RTMP message'''
+    def fromMessage(cls, message, lazy=False):
+        ''' initialize from a parsed RTMP message. If lazy is set, return a CommandView which decodes only the name until needed.'''
+        if lazy: return CommandView(message)
+        inst, amfReader = cls(), Command._reader(message)
+        inst.type, inst.time, inst.name = message.type, message.time, amfReader.read() # first field is command name
+        inst._decode(amfReader)
+        return inst
+    
+    @staticmethod
+    def _reader(message):
         assert (message.type in [Message.RPC, Message.RPC3, Message.DATA, Message.DATA3])
 
         length = len(message.data)
@@ -585,25 +832,20 @@ class Command(object):
         else:
             data = message.data
         
-        amfReader = amf.AMF0(data)
-
-        inst = cls()
-        inst.type = message.type
-        inst.time = message.time
-        inst.name = amfReader.read() # first field is command name
-
+        return amf.AMF0(data)
+    
+    def _decode(self, amfReader): # decode the fields after name
+        self.id, self.cmdData, self.args = None, None, []
         try:
-            if message.type == Message.RPC or message.type == Message.RPC3:
-                inst.id = amfReader.read() # second field *may* be message id
-                inst.cmdData = amfReader.read() # third is command data
+            if self.type == Message.RPC or self.type == Message.RPC3:
+                self.id = amfReader.read() # second field *may* be message id
+                self.cmdData = amfReader.read() # third is command data
             else:
-                inst.id = 0
-            inst.args = [] # others are optional
-            while True:
-                inst.args.append(amfReader.read())
+                self.id = 0
+            while True: # others are optional
+                self.args.append(amfReader.read())
         except EOFError:
             pass
-        return inst
     
     def toMessage(self):
         msg = Message()
@@ -629,6 +871,43 @@ class Command(object):
         output.close()
         return msg
 
+class CommandTemplate(object):
+    '''A pre-encoded Command with amf.Slot placeholders for the variable id or args, e.g., for the onStatus of publish or play.
+    The id is a slot by default. Use toMessage(**values) to get the message with the values of the slots.'''
+    statuses = {} # (level, code) => CommandTemplate for status()
+    def __init__(self, name, args=[], type=Message.RPC, id=amf.Slot('id'), cmdData=None):
+        self.type = type
+        self.template = amf.Template(name, id, cmdData, *args) if type in (Message.RPC, Message.RPC3) else amf.Template(name, *args)
+    
+    def toMessage(self, tm=0, type=None, **values):
+        '''Return the message with the given values of the slots, and optional type to override, e.g., Message.RPC3.'''
+        msg = Message()
+        msg.type, msg.time = type or self.type, tm
+        data = self.template.encode(**values)
+        msg.data = '\x00' + data if msg.type in (Message.RPC3, Message.DATA3) else data
+        return msg
+    
+    @staticmethod
+    def status(id, tm, level, code, description=''):
+        '''Return the onStatus message for the stream id, using the cached template of level and code.'''
+        template = CommandTemplate.statuses.get((level, code))
+        if template is None:
+            template = CommandTemplate.statuses[(level, code)] = CommandTemplate('onStatus', [amf.Object(level=level, code=code, description=amf.Slot('description'), details=None)])
+        return template.toMessage(tm=tm, id=id, description=description)
+
+class CommandView(Command):
+    '''A lazy Command of a received message, which decodes only the name on creation, and the id, cmdData and args when any of
+    them is first accessed. The raw bytes remain in message, e.g., to forward a data message without encoding it again.'''
+    def __init__(self, message):
+        self.message, self._amfReader = message, Command._reader(message)
+        self.type, self.time, self.name = message.type, message.time, self._amfReader.read()
+    
+    def __getattr__(self, attr): # invoked only if not yet decoded
+        if attr not in ('id', 'cmdData', 'args') or self._amfReader is None: raise AttributeError(attr)
+        amfReader, self._amfReader = self._amfReader, None
+        self._decode(amfReader)
+        return getattr(self, attr)
+
 def getfilename(path, name, root):
     '''return the file name for the given stream. The name is derived as root/scope/name.flv where scope is
     the the path present in the path variable.'''
@@ -640,24 +919,31 @@ def getfilename(path, name, root):
 
 class FLV(object):
     '''An FLV file which converts between RTMP message and FLV tags.'''
+    cache = None # a VODCache to read files from shared memory maps, or None to read each file separately
+    writer = None # a RecordWriter to write recorded tags in a background thread, or None to write them inline
+    BUFFER_TIME, PACE_WINDOW = 1000, 200 # millisec of media sent ahead if the client did not set buffer length, and per wakeup
+    
     def __init__(self):
-        self.fname = self.fp = self.type = None
+        self.fname = self.fp = self.type = self.index = self.vod = self.pace0 = None
         self.tsp = self.tsr = 0; self.tsr0 = None
     
     def open(self, path, type='read', mode=0775):
         '''Open the file for reading (type=read) or writing (type=record or append).'''
         if str(path).find('/../') >= 0 or str(path).find('\\..\\') >= 0: raise ValueError('Must not contain .. in name')
         if _debug: print 'opening file', path
-        self.tsp = self.tsr = 0; self.tsr0 = None; self.tsr1 = 0; self.type = type
+        self.tsp = self.tsr = 0; self.tsr0 = None; self.tsr1 = 0; self.type = type; self.fname, self.index = path, None
         if type in ('record', 'append'):
+            if FLV.writer is not None: FLV.writer.wait(path) # previous recording of this file may still be pending
             try: os.makedirs(os.path.dirname(path), mode)
             except: pass
             if type == 'record' or not os.path.exists(path): # if file does not exist, use record mode
                 self.fp = open(path, 'w+b')
                 self.fp.write('FLV\x01\x05\x00\x00\x00\x09\x00\x00\x00\x00') # the header and first previousTagSize
                 self.writeDuration(0.0)
+                self.index = [] # key frames are added as they are written
             else:
                 self.fp = open(path, 'r+b')
+                self.index = self.keyframes()
                 self.fp.seek(-4, os.SEEK_END)
                 ptagsize, = struct.unpack('>I', self.fp.read(4))
                 self.fp.seek(-4-ptagsize, os.SEEK_END)
@@ -666,7 +952,10 @@ class FLV(object):
                 ts = (ts0 << 16) | (ts1 & 0x0ffff) | (ts2 << 24)
                 self.tsr1 = ts + 20; # some offset after the last packet
                 self.fp.seek(0, os.SEEK_END)
+            self.offset = self.fp.tell() # of the next tag, tracked here because the writer thread may lag behind
         else: 
+            self.vod, self.tag = FLV.cache.get(path) if FLV.cache is not None else None, 0 # index of next tag to read from vod
+            if self.vod is not None: return self
             self.fp = open(path, 'rb')
             magic, version, flags, offset = struct.unpack('!3sBBI', self.fp.read(9))
             if _debug: print 'FLV.open() hdr=', magic, version, flags, offset
@@ -679,20 +968,76 @@ class FLV(object):
     def close(self):
         '''Close the underlying file for this object.'''
         if _debug: print 'closing flv file'
-        if self.type in ('record', 'append') and self.tsr0 is not None:
-            self.writeDuration((self.tsr - self.tsr0)/1000.0)
-        if self.fp is not None: 
-            try: self.fp.close()
-            except: pass
-            self.fp = None
+        recording = self.type in ('record', 'append')
+        duration = (self.tsr - self.tsr0)/1000.0 if recording and self.tsr0 is not None else None
+        fp, self.fp, self.vod = self.fp, None, None
+        if fp is not None:
+            if recording and FLV.writer is not None: FLV.writer.call(lambda: self._close(fp, duration), self.fname) # after the pending writes
+            else: self._close(fp, duration)
+
+    def _close(self, fp, duration):
+        if duration is not None: self.writeDuration(duration, fp)
+        try: fp.close()
+        except: pass
+        if self.type in ('record', 'append') and self.index is not None: self.saveIndex()
     
     def delete(self, path):
         '''Delete the underlying file for this object.'''
-        try: os.unlink(path)
-        except: pass
+        for name in (path, path + '.idx'):
+            try: os.unlink(name)
+            except: pass
+    
+    def keyframes(self):
+        '''Return the list of (timestamp, offset) of the video key frames in the file. It is loaded from the sidecar index file
+        (fname.idx) if up to date, else built by reading only the tag headers and saved in the sidecar file.'''
+        if self.index is None:
+            self.index = self.loadIndex()
+            if self.index is None:
+                self.index = self.scanIndex()
+                self.saveIndex()
+        return self.index
+    
+    def scanIndex(self):
+        '''Return the list of (timestamp, offset) of the video key frames by reading the tag headers from the start of the file.'''
+        fp, result, lastpos = self.fp, [], self.fp.tell()
+        fp.seek(0, os.SEEK_SET)
+        magic, version, flags, offset = struct.unpack('!3sBBI', fp.read(9))
+        pos = offset + 4 # ignore first previous tag size
+        while True:
+            fp.seek(pos, os.SEEK_SET)
+            bytes = fp.read(12) # tag header and first byte of body
+            if len(bytes) < 12: break
+            type, len0, len1, ts0, ts1, ts2, sid0, sid1, first = struct.unpack('>BBHBHBBHB', bytes)
+            length = (len0 << 16) | len1; ts = (ts0 << 16) | (ts1 & 0x0ffff) | (ts2 << 24)
+            if type == Message.VIDEO and length > 0 and first >> 4 == 1: result.append((ts, pos))
+            pos += 11 + length + 4
+        fp.seek(lastpos, os.SEEK_SET)
+        if _debug: print 'FLV.scanIndex() found', len(result), 'key frames'
+        return result
+    
+    def loadIndex(self):
+        '''Return the key frame index from the sidecar file, or None if it does not exist or is older than the file.'''
+        try:
+            name = self.fname + '.idx'
+            if os.path.getmtime(name) < os.path.getmtime(self.fname): return None
+            f = open(name, 'rb'); data = f.read(); f.close()
+            magic, size = struct.unpack('>4sQ', data[:12])
+            if magic != 'FLVI' or size != os.path.getsize(self.fname): return None
+            values = struct.unpack('>' + 'IQ' * ((len(data) - 12) / 12), data[12:])
+            return zip(values[0::2], values[1::2])
+        except: return None
+    
+    def saveIndex(self):
+        '''Save the key frame index in the sidecar file, ignoring any error, e.g., read-only directory.'''
+        try:
+            data = struct.pack('>4sQ', 'FLVI', os.path.getsize(self.fname)) + ''.join([struct.pack('>IQ', ts, pos) for ts, pos in self.index])
+            f = open(self.fname + '.idx', 'wb'); f.write(data); f.close()
+        except:
+            if _debug: print 'FLV.saveIndex() failed', (sys and sys.exc_info() or None)
         
-    def writeDuration(self, duration):
+    def writeDuration(self, duration, fp=None):
         if _debug: print 'writing duration', duration
+        fp = fp or self.fp
         output = amf.BytesIO()
         amfWriter = amf.AMF0(output) # TODO: use AMF3 if needed
         amfWriter.write('onMetaData')
@@ -701,10 +1046,10 @@ class FLV(object):
         length, ts = len(data), 0
         data = struct.pack('>BBHBHB', Message.DATA, (length >> 16) & 0xff, length & 0x0ffff, (ts >> 16) & 0xff, ts & 0x0ffff, (ts >> 24) & 0xff) + '\x00\x00\x00' +  data
         data += struct.pack('>I', len(data))
-        lastpos = self.fp.tell()
-        if lastpos != 13: self.fp.seek(13, os.SEEK_SET)
-        self.fp.write(data)
-        if lastpos != 13: self.fp.seek(lastpos, os.SEEK_SET)
+        lastpos = fp.tell()
+        if lastpos != 13: fp.seek(13, os.SEEK_SET)
+        fp.write(data)
+        if lastpos != 13: fp.seek(lastpos, os.SEEK_SET)
         
     def write(self, message):
         '''Write a message to the file, assuming it was opened for writing or appending.'''
@@ -719,43 +1064,50 @@ class FLV(object):
             # if message.type == Message.AUDIO: print 'w', message.type, ts
             data = struct.pack('>BBHBHB', message.type, (length >> 16) & 0xff, length & 0x0ffff, (ts >> 16) & 0xff, ts & 0x0ffff, (ts >> 24) & 0xff) + '\x00\x00\x00' +  message.data
             data += struct.pack('>I', len(data))
-            self.fp.write(data)
+            if FLV.writer is not None:
+                if not FLV.writer.write(self.fp, data):
+                    if _debug: print 'FLV.write() dropped', FLV.writer.dropped, 'lag', FLV.writer.lag
+                    return
+            else: self.fp.write(data)
+            if self.index is not None and message.type == Message.VIDEO and message.data[:1] and ord(message.data[0]) >> 4 == 1:
+                self.index.append((ts, self.offset)) # key frame
+            self.offset += len(data)
     
     def reader(self, stream):
         '''A generator to periodically read the file and dispatch them to the stream. The supplied stream
-        object must have a send(Message) method and id and client properties.'''
+        object must have a send(Message) method and id and client properties. After start or seek, the tags
+        are sent without waiting until the client's buffer length of media is sent, and then paced with one
+        wakeup every PACE_WINDOW millisec instead of one per tag.'''
         if _debug: print 'reader started'
         yield
         try:
-            while self.fp is not None:
-                bytes = self.fp.read(11)
-                if len(bytes) == 0:
+            while self.fp is not None or self.vod is not None:
+                tag = self.readTag()
+                if tag is None:
+                    remaining = self.pace0 and (self.tsp - self.pace0[1] - 1000*(time.time() - self.pace0[0])) or 0
+                    if remaining > 0: yield multitask.sleep(remaining / 1000.0) # so that stop is sent at the end in real time
                     try: tm = stream.client.relativeTime
                     except: tm = 0
-                    response = Command(name='onStatus', id=stream.id, tm=tm, args=[amf.Object(level='status',code='NetStream.Play.Stop', description='File ended', details=None)])
-                    yield stream.send(response.toMessage())
+                    yield stream.send(CommandTemplate.status(stream.id, tm, 'status', 'NetStream.Play.Stop', 'File ended'))
                     break
-                type, len0, len1, ts0, ts1, ts2, sid0, sid1 = struct.unpack('>BBHBHBBH', bytes)
-                length = (len0 << 16) | len1; ts = (ts0 << 16) | (ts1 & 0x0ffff) | (ts2 << 24)
-                body = self.fp.read(length); ptagsize, = struct.unpack('>I', self.fp.read(4))
-                if ptagsize != (length+11): 
-                    if _debug: print 'invalid previous tag-size found:', ptagsize, '!=', (length+11),'ignored.'
+                type, ts, body = tag; length = len(body)
                 if stream is None or stream.client is None: break # if it is closed
                 #hdr = Header(3 if type == Message.AUDIO else 4, ts if ts < 0xffffff else 0xffffff, length, type, stream.id)
                 hdr = Header(0, ts, length, type, stream.id)
                 msg = Message(hdr, body)
                 # if _debug: print 'FLV.read() length=', length, 'hdr=', hdr
                 # if hdr.type == Message.AUDIO: print 'r', hdr.type, hdr.time
-                if type == Message.DATA: # metadata
-                    amfReader = amf.AMF0(body) # TODO: use AMF3 if needed
-                    name = amfReader.read()
-                    obj = amfReader.read()
-                    if _debug: print 'FLV.read()', name, repr(obj)
+                if _debug and type == Message.DATA: # metadata is forwarded without decoding
+                    cmd = CommandView(msg)
+                    print 'FLV.read()', cmd.name, repr(cmd.args)
                 yield stream.send(msg)
-                if ts > self.tsp: 
-                    diff, self.tsp = ts - self.tsp, ts
-                    if _debug: print 'FLV.read() sleep', diff
-                    yield multitask.sleep(diff / 1000.0)
+                if self.pace0 is None: self.pace0 = (time.time(), ts) # wall clock and media time after start or seek
+                self.tsp = max(self.tsp, ts)
+                bufferTime = getattr(stream.client, 'bufferTimes', {}).get(stream.id, 0) or FLV.BUFFER_TIME
+                ahead = ts - self.pace0[1] - 1000*(time.time() - self.pace0[0]) - bufferTime # millisec sent beyond the buffer
+                if ahead > 0:
+                    if _debug: print 'FLV.read() sleep', ahead + FLV.PACE_WINDOW
+                    yield multitask.sleep((ahead + FLV.PACE_WINDOW) / 1000.0)
         except StopIteration: pass
         except: 
             if _debug: print 'closing the reader', (sys and sys.exc_info() or None)
@@ -763,11 +1115,39 @@ class FLV(object):
                 try: self.fp.close()
                 except: pass
                 self.fp = None
+            self.vod = None
+    
+    def readTag(self):
+        '''Return (type, timestamp, body) of the next tag of the file opened for reading, or None at the end of the file.'''
+        if self.vod is not None:
+            if self.tag >= len(self.vod): return None
+            self.tag += 1
+            return self.vod.tag(self.tag - 1)
+        bytes = self.fp.read(11)
+        if len(bytes) == 0: return None
+        type, len0, len1, ts0, ts1, ts2, sid0, sid1 = struct.unpack('>BBHBHBBH', bytes)
+        length = (len0 << 16) | len1; ts = (ts0 << 16) | (ts1 & 0x0ffff) | (ts2 << 24)
+        body = self.fp.read(length); ptagsize, = struct.unpack('>I', self.fp.read(4))
+        if ptagsize != (length+11): 
+            if _debug: print 'invalid previous tag-size found:', ptagsize, '!=', (length+11),'ignored.'
+        return type, ts, body
             
     def seek(self, offset):
-        '''For file reader, try seek to the given time. The offset is in millisec'''
-        if self.type == 'read':
+        '''For file reader, try seek to the given time. The offset is in millisec. It lands on the nearest key frame at or before the
+        offset using the key frame index, or if there is no such key frame, on the first tag at or after the offset.'''
+        self.pace0 = None # to send the buffer length again from the new position
+        if self.type == 'read' and self.vod is not None:
+            self.tag, self.tsp = self.vod.seek(int(offset))
+            if _debug: print 'FLV.seek() new ts=', self.tsp, 'tag', self.tag
+        elif self.type == 'read':
             if _debug: print 'FLV.seek() offset=', offset, 'current tsp=', self.tsp
+            index = self.keyframes()
+            i = bisect.bisect_right(index, (int(offset), sys.maxint)) - 1
+            if i >= 0:
+                self.tsp, pos = index[i]
+                self.fp.seek(pos, os.SEEK_SET)
+                if _debug: print 'FLV.seek() new ts=', self.tsp, 'tell', pos
+                return
             self.fp.seek(0, os.SEEK_SET)
             magic, version, flags, length = struct.unpack('!3sBBI', self.fp.read(9))
             if length > 9: self.fp.seek(length-9, os.SEEK_CUR)
@@ -782,14 +1162,149 @@ class FLV(object):
                 ptagsize, = struct.unpack('>I', self.fp.read(4))
                 if ptagsize != (length+11): break
             if _debug: print 'FLV.seek() new ts=', ts, 'tell', self.fp.tell()
-                
+
+class VODFile(object):
+    '''A read-only memory map of an FLV file with its tag table, which is parsed once and shared by all the readers of the file.'''
+    def __init__(self, path):
+        f = open(path, 'rb')
+        try:
+            stat = os.fstat(f.fileno())
+            self.stat, self.map = (stat.st_size, stat.st_mtime), mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally: f.close()
+        magic, version, flags, offset = struct.unpack_from('!3sBBI', self.map, 0)
+        if magic != 'FLV': raise ValueError('This is not a FLV file')
+        if version != 1: raise ValueError('Unsupported FLV file version')
+        self.offsets, self.sizes, self.times, self.types = array.array('L'), array.array('L'), array.array('L'), array.array('B')
+        self.keys = [] # (timestamp, tag index) of video key frames
+        pos, size = offset + 4, len(self.map) # ignore first previous tag size
+        while pos + 11 <= size:
+            type, len0, len1, ts0, ts1, ts2 = struct.unpack_from('>BBHBHB', self.map, pos)
+            length = (len0 << 16) | len1; ts = (ts0 << 16) | (ts1 & 0x0ffff) | (ts2 << 24)
+            if pos + 11 + length > size: break # incomplete last tag
+            if type == Message.VIDEO and length > 0 and ord(self.map[pos+11]) >> 4 == 1: self.keys.append((ts, len(self.offsets)))
+            self.offsets.append(pos + 11); self.sizes.append(length); self.times.append(ts); self.types.append(type)
+            pos += 11 + length + 4
+        self.tableSize = sum([a.itemsize * len(a) for a in (self.offsets, self.sizes, self.times, self.types)]) + 80 * len(self.keys)
+        
+    def __len__(self):
+        return len(self.offsets)
+    
+    def tag(self, index):
+        '''Return (type, timestamp, body) of the tag at index. The body is copied once from the map into a new str, because the
+        messages are chunked and written with str operations that do not accept a buffer.'''
+        start = self.offsets[index]
+        return self.types[index], self.times[index], self.map[start:start+self.sizes[index]]
+    
+    def seek(self, offset):
+        '''Return (tag index, timestamp) of the nearest key frame at or before offset in millisec, or if there is no such key frame,
+        of the first tag at or after offset.'''
+        i = bisect.bisect_right(self.keys, (offset, sys.maxint)) - 1
+        if i >= 0: return self.keys[i][1], self.keys[i][0]
+        for index, ts in enumerate(self.times):
+            if ts >= offset: return index, ts
+        return len(self.times), offset
+        
+class VODCache(object):
+    '''A process wide cache of VODFile indexed by path, so that a file played by many clients is mapped and parsed once. The least
+    recently used files are removed when the mapped bytes exceed maxSize or the tag tables exceed maxTableSize. A removed file
+    remains usable by its existing readers.'''
+    def __init__(self, maxSize=1000000000, maxTableSize=50000000):
+        self.maxSize, self.maxTableSize, self.size, self.tableSize = maxSize, maxTableSize, 0, 0
+        self.files = collections.OrderedDict()
+    
+    def get(self, path):
+        '''Return the VODFile for path, mapping it if not cached or if the file has changed, or None if it cannot be mapped.'''
+        vod = self.files.pop(path, None)
+        try: stat = os.stat(path); stat = (stat.st_size, stat.st_mtime)
+        except OSError: stat = None
+        if vod is not None and vod.stat != stat: # changed, e.g., by recording, hence map again
+            self.size, self.tableSize, vod = self.size - vod.stat[0], self.tableSize - vod.tableSize, None
+        if vod is None:
+            try: vod = VODFile(path)
+            except: 
+                if _debug: print 'VODCache.get() failed', path, (sys and sys.exc_info() or None)
+                return None
+            self.size, self.tableSize = self.size + vod.stat[0], self.tableSize + vod.tableSize
+            while self.files and (self.size > self.maxSize or self.tableSize > self.maxTableSize):
+                ignore, old = self.files.popitem(last=False) # least recently used
+                self.size, self.tableSize = self.size - old.stat[0], self.tableSize - old.tableSize
+        self.files[path] = vod # most recently used
+        return vod
+
+class RecordWriter(object):
+    '''A background thread that writes the tags of the recorded FLV files, so that a slow disk does not stall the event loop.
+    Up to maxSize bytes are queued, beyond which new tags are dropped and counted in dropped. The queued tags are coalesced
+    into one write per file, and the written files are flushed to disk every fsyncInterval seconds if set. The lag is the
+    age in seconds of the oldest tag in the last batch written. The number of queued items is counted per path, so that a
+    file is reopened only after its own pending items are done, without waiting for the other recordings.'''
+    def __init__(self, maxSize=16000000, fsyncInterval=0):
+        self.maxSize, self.fsyncInterval, self.size, self.dropped, self.lag = maxSize, fsyncInterval, 0, 0, 0
+        self.queue, self.lock, self.pending = Queue.Queue(), threading.Lock(), {} # number of queued items indexed by path
+        self.done = threading.Condition(self.lock)
+        thread = threading.Thread(target=self.run, name='RecordWriter'); thread.daemon = True; thread.start()
+
+    def write(self, fp, data):
+        '''Queue data to be appended to the file fp. Return False if it was dropped because the queue is full.'''
+        with self.lock:
+            if self.size + len(data) > self.maxSize: self.dropped += 1; return False
+            self.size += len(data)
+            self.pending[fp.name] = self.pending.get(fp.name, 0) + 1
+        self.queue.put((fp, data, time.time(), fp.name))
+        return True
+
+    def call(self, func, path=None):
+        '''Queue func to be invoked in the writer thread after all the writes queued before it, e.g., to close the file of path.'''
+        with self.lock: self.pending[path] = self.pending.get(path, 0) + 1
+        self.queue.put((None, func, time.time(), path))
+
+    def wait(self, path):
+        '''Wait until the queued writes and calls of path are done. It returns at once if there are none.'''
+        with self.lock:
+            while self.pending.get(path, 0): self.done.wait()
+
+    def join(self):
+        '''Wait until all the queued writes and calls are done.'''
+        self.queue.join()
+
+    def run(self):
+        synced, dirty = time.time(), set()
+        while True:
+            items = [self.queue.get()]
+            try:
+                while len(items) < 1000: items.append(self.queue.get_nowait())
+            except Queue.Empty: pass
+            self.lag, segments, last = time.time() - items[0][2], [], None
+            for fp, data, ts, path in items + [(None, None, 0, None)]:
+                if fp is not last and segments: # write the coalesced tags of the previous file
+                    try: last.write(''.join(segments)); dirty.add(last)
+                    except: print 'RecordWriter write failed', (sys and sys.exc_info() or None)
+                    with self.lock: self.size -= sum(map(len, segments))
+                    segments = []
+                if fp is not None: segments.append(data)
+                elif data is not None:
+                    try: data()
+                    except: print traceback.print_exc()
+                last = fp
+            if self.fsyncInterval and time.time() - synced >= self.fsyncInterval:
+                for fp in dirty:
+                    try: fp.flush(); os.fsync(fp.fileno())
+                    except: pass # closed file
+                synced, dirty = time.time(), set()
+            elif not self.fsyncInterval: dirty.clear()
+            with self.lock:
+                for item in items:
+                    count = self.pending[item[3]] = self.pending[item[3]] - 1
+                    if not count: del self.pending[item[3]]
+                self.done.notify_all()
+            for item in items: self.queue.task_done()
         
 class Stream(object):
     '''The stream object that is used for RTMP stream.'''
     count = 0;
     def __init__(self, client):
         self.client, self.id, self.name = client, 0, ''
-        self.recordfile = self.playfile = None # so that it doesn't complain about missing attribute
+        self.recordfile = self.playfile = self.gop = None # so that it doesn't complain about missing attribute
+        self.droppedVideo = self.droppedAudio = self.keyframeSkips = 0; self.skipping = False # for the drop policy of live media
         self.queue = multitask.Queue()
         self._name = 'Stream[' + str(Stream.count) + ']'; Stream.count += 1
         if _debug: print self, 'created'
@@ -815,6 +1330,79 @@ class Stream(object):
         msg.streamId = self.id
         # if _debug: print self,'send'
         if self.client is not None: yield self.client.writeMessage(msg)
+    
+    def admit(self, msg):
+        '''Apply the drop policy for a live media message to be sent on this stream, and return True if it should be sent. When the
+        client is congested, the video is dropped until the next key frame, which is sent unless the client is congested more than
+        twice the limit. Audio is dropped only above twice the limit. The AVC and AAC sequence headers are never dropped, because
+        they are sent only once per publish and the player cannot decode without them.'''
+        if msg.type not in (Message.AUDIO, Message.VIDEO) or self.client is None: return True
+        level, data = self.client.congestion(), msg.data
+        if msg.type == Message.AUDIO:
+            if level < 2: return True
+            if data[1:2] == '\x00' and data[:1] and ord(data[0]) >> 4 == 10: return True # AAC sequence header
+            self.droppedAudio += 1; return False
+        if data[1:2] == '\x00' and data[:1] and ord(data[0]) & 0x0f == 7: # AVC sequence header
+            return True
+        if data[:1] and ord(data[0]) >> 4 == 1 and level < 2: # key frame
+            self.skipping = False; return True
+        if not self.skipping and level == 0: return True
+        if not self.skipping: self.skipping, self.keyframeSkips = True, self.keyframeSkips + 1
+        self.droppedVideo += 1; return False
+
+class GOPCache(object):
+    '''The last group of pictures (GOP) of a published stream, i.e., the metadata, the audio and video codec sequence headers, and
+    all the audio and video messages since the last video key frame. A new player gets these immediately so that it can start
+    decoding without waiting for the next key frame. The messages are dropped until the next key frame if the total size in bytes
+    exceeds maxSize.'''
+    def __init__(self, maxSize):
+        self.maxSize, self.gopSize, self.messages, self.metaData, self.audioSeq, self.videoSeq = maxSize, 0, [], None, None, None
+    
+    @property
+    def size(self): return self.gopSize + sum([m.size for m in (self.metaData, self.audioSeq, self.videoSeq) if m is not None])
+        
+    def add(self, message):
+        '''Update the cache with a published message, and return the change in the cached size.'''
+        before, data = self.size, message.data
+        if message.type == Message.DATA:
+            if 'onMetaData' not in data[:32]: return 0
+            self.metaData = message
+        elif message.type == Message.VIDEO and data[:1] and ord(data[0]) & 0x0f == 7 and data[1:2] == '\x00': # AVC sequence header
+            self.videoSeq = message
+        elif message.type == Message.AUDIO and data[:1] and ord(data[0]) >> 4 == 10 and data[1:2] == '\x00': # AAC sequence header
+            self.audioSeq = message
+        elif message.type == Message.VIDEO and data[:1] and ord(data[0]) >> 4 == 1: # key frame starts a new GOP
+            self.messages, self.gopSize = [message], message.size
+        elif message.type in (Message.AUDIO, Message.VIDEO) and self.messages:
+            self.messages.append(message); self.gopSize += message.size
+        else: 
+            return 0
+        if self.size > self.maxSize: self.drop() # wait for next key frame
+        return self.size - before
+    
+    def drop(self):
+        '''Drop the messages of the GOP until the next key frame, but keep the metadata and sequence headers which the publisher
+        sends only once. Return the size that was released.'''
+        size, self.messages, self.gopSize = self.gopSize, [], 0
+        return size
+    
+    def clear(self):
+        '''Drop all the cached messages, and return the size that was released.'''
+        size, self.gopSize, self.messages, self.metaData, self.audioSeq, self.videoSeq = self.size, 0, [], None, None, None
+        return size
+        
+    def burst(self, streamId):
+        '''Return copies of the cached messages for a new player of the given streamId. The metadata and sequence headers are
+        rebased to the time of the key frame, so that the time stamps increase. Empty if there is no key frame yet.'''
+        if not self.messages: return []
+        result, start = [], self.messages[0].time
+        for m in [m for m in (self.metaData, self.videoSeq, self.audioSeq) if m is not None]:
+            c = m.dup(); c.frame, c.streamId, c.time = getattr(m, 'frame', None), streamId, start
+            result.append(c)
+        for m in self.messages:
+            c = m.dup(); c.frame, c.streamId = getattr(m, 'frame', None), streamId
+            result.append(c)
+        return result
         
 class Client(Protocol):
     '''The client object represents a single connected client to the server.'''
@@ -837,7 +1425,7 @@ class Client(Protocol):
             
     def messageReceived(self, msg):
         if (msg.type == Message.RPC or msg.type == Message.RPC3) and msg.streamId == 0:
-            cmd = Command.fromMessage(msg)
+            cmd = Command.fromMessage(msg, lazy=True)
             # if _debug: print 'rtmp.Client.messageReceived cmd=', cmd
             if cmd.name == 'connect':
                 self.agent = cmd.cmdData
@@ -874,34 +1462,29 @@ class Client(Protocol):
         # TODO: reverting r141 since it causes exception in setting self.rpc
         return Message.RPC if self.objectEncoding == 0.0 else Message.RPC3
     
+    # pre-encoded responses to connect, with slots for the variable fields
+    ACCEPT = CommandTemplate('_result', [amf.Object(level='status', code='NetConnection.Connect.Success', description='Connection succeeded.', fmsVer='rtmplite/8,2')], id=1)
+    ACCEPT_ENCODING = CommandTemplate('_result', [amf.Object(level='status', code='NetConnection.Connect.Success', description='Connection succeeded.', fmsVer='rtmplite/8,2',
+                                      objectEncoding=amf.Slot('objectEncoding'), details=None)], id=1)
+    REJECT = CommandTemplate('_error', [amf.Object(level='status', code='NetConnection.Connect.Rejected', description=amf.Slot('description'), fmsVer='rtmplite/8,2', details=None)], id=1)
+    REDIRECT = CommandTemplate('_error', [amf.Object(level='status', code='NetConnection.Connect.Rejected', description=amf.Slot('description'), fmsVer='rtmplite/8,2', details=None,
+                               ex=dict(code=302, redirect=amf.Slot('url')))], id=1)
+    
     def accept(self):
         '''Method to accept an incoming client.'''
-        response = Command()
-        response.id, response.name, response.type = 1, '_result', self.rpc
         if _debug: print 'Client.accept() objectEncoding=', self.objectEncoding
-        arg = amf.Object(level='status', code='NetConnection.Connect.Success',
-                         description='Connection succeeded.', fmsVer='rtmplite/8,2')
         if hasattr(self.agent, 'objectEncoding'):
-            arg.objectEncoding, arg.details = self.objectEncoding, None
-        response.setArg(arg)
-        yield self.writeMessage(response.toMessage())
+            yield self.writeMessage(Client.ACCEPT_ENCODING.toMessage(type=self.rpc, objectEncoding=self.objectEncoding))
+        else:
+            yield self.writeMessage(Client.ACCEPT.toMessage(type=self.rpc))
             
     def rejectConnection(self, reason=''):
         '''Method to reject an incoming client.'''
-        response = Command()
-        response.id, response.name, response.type = 1, '_error', self.rpc
-        response.setArg(amf.Object(level='status', code='NetConnection.Connect.Rejected',
-                        description=reason, fmsVer='rtmplite/8,2', details=None))
-        yield self.writeMessage(response.toMessage())
+        yield self.writeMessage(Client.REJECT.toMessage(type=self.rpc, description=reason))
             
     def redirectConnection(self, url, reason='Connection failed'):
         '''Method to redirect an incoming client to the given url.'''
-        response = Command()
-        response.id, response.name, response.type = 1, '_error', self.rpc
-        extra = dict(code=302, redirect=url)
-        response.setArg(amf.Object(level='status', code='NetConnection.Connect.Rejected',
-                        description=reason, fmsVer='rtmplite/8,2', details=None, ex=extra))
-        yield self.writeMessage(response.toMessage())
+        yield self.writeMessage(Client.REDIRECT.toMessage(type=self.rpc, description=reason, url=url))
 
     def call(self, method, *args):
         '''Call a (callback) method on the client.'''
@@ -1057,6 +1640,8 @@ class FlashServer(object):
         self.apps = dict({'*': App, 'wirecast': Wirecast}) # supported applications: * means any as in {'*': App}
         self.clients = dict()  # list of clients indexed by scope. First item in list is app instance.
         self.root = '';
+        self.gopCache = 0 # max bytes of the last GOP cached per published stream for new players, or 0 to disable.
+        self.gopCacheLimit, self.gopCacheSize = 64000000, 0 # max and current bytes of all GOP caches in this server.
         
     def start(self, host='0.0.0.0', port=1935):
         '''This should be used to start listening for RTMP connections on the given port, which defaults to 1935.'''
@@ -1174,6 +1759,7 @@ class FlashServer(object):
             if stream.name in inst.publishers and inst.publishers[stream.name] == stream: # clear the published stream
                 inst.onClose(stream.client, stream)
                 del inst.publishers[stream.name]
+                if stream.gop is not None: self.gopCacheSize -= stream.gop.clear(); stream.gop = None
             if stream.name in inst.players and stream in inst.players[stream.name]:
                 inst.onStop(stream.client, stream)
                 inst.players[stream.name].remove(stream)
@@ -1224,7 +1810,7 @@ class FlashServer(object):
         '''A generator to handle a single message on the stream.'''
         try:
             if message.type == Message.RPC or message.type == Message.RPC3:
-                cmd = Command.fromMessage(message)
+                cmd = Command.fromMessage(message, lazy=True)
                 if _debug: print 'streamhandler received cmd=', cmd
                 if cmd.name == 'publish':
                     yield self.publishhandler(stream, cmd)
@@ -1253,13 +1839,14 @@ class FlashServer(object):
                 raise ValueError, 'Stream name already in use'
             inst.publishers[stream.name] = stream # store the client for publisher
             inst.onPublish(stream.client, stream)
+            if self.gopCache: stream.gop = GOPCache(self.gopCache)
             
             stream.recordfile = inst.getfile(stream.client.path, stream.name, self.root, stream.mode)
-            response = Command(name='onStatus', id=cmd.id, tm=stream.client.relativeTime, args=[amf.Object(level='status', code='NetStream.Publish.Start', description='', details=None)])
+            response = CommandTemplate.status(cmd.id, stream.client.relativeTime, 'status', 'NetStream.Publish.Start', '')
             yield stream.send(response)
         except ValueError, E: # some error occurred. inform the app.
             if _debug: print 'error in publishing stream', str(E)
-            response = Command(name='onStatus', id=cmd.id, tm=stream.client.relativeTime, args=[amf.Object(level='error',code='NetStream.Publish.BadName',description=str(E),details=None)])
+            response = CommandTemplate.status(cmd.id, stream.client.relativeTime, 'error', 'NetStream.Publish.BadName', str(E))
             yield stream.send(response)
 
     def playhandler(self, stream, cmd):
@@ -1271,7 +1858,9 @@ class FlashServer(object):
             start = cmd.args[1] if len(cmd.args) >= 2 else -2
             if name not in inst.players:
                 inst.players[name] = [] # initialize the players for this stream name
-            if stream not in inst.players[name]: # store the stream as players of this name
+            publisher = inst.publishers.get(name, None) if start in (-2, -1) else None
+            gop = publisher.gop if publisher is not None and publisher.gop and publisher.gop.messages else None # if present, player is added with the burst
+            if stream not in inst.players[name] and gop is None: # store the stream as players of this name
                 inst.players[name].append(stream)
             task = None
             if start >= 0 or start == -2 and name not in inst.publishers:
@@ -1301,16 +1890,20 @@ class FlashServer(object):
 #            response = Command(name='onStatus', id=cmd.id, args=[amf.Object(level='status',code='NetStream.Play.Reset', description=stream.name, details=None)])
 #            yield stream.send(response)
             
-            response = Command(name='onStatus', id=cmd.id, tm=stream.client.relativeTime, args=[amf.Object(level='status',code='NetStream.Play.Start', description=stream.name, details=None)])
+            response = CommandTemplate.status(cmd.id, stream.client.relativeTime, 'status', 'NetStream.Play.Start', stream.name)
             yield stream.send(response)
             
 #            response = Command(name='onStatus', id=cmd.id, tm=stream.client.relativeTime, args=[amf.Object(level='status',code='NetStream.Play.PublishNotify', description=stream.name, details=None)])
 #            yield stream.send(response)
             
             if task is not None: multitask.add(task)
+            if gop is not None: # without yield between adding the player and queueing the last GOP, so that nothing is missed
+                if stream not in inst.players.setdefault(name, []): inst.players[name].append(stream)
+                burst = [m for m in gop.burst(stream.id) if inst.onPlayData(stream.client, stream, m)]
+                if burst and stream.client is not None: yield stream.client.writeQueue.put(burst)
         except ValueError, E: # some error occurred. inform the app.
             if _debug: print 'error in playing stream', str(E)
-            response = Command(name='onStatus', id=cmd.id, tm=stream.client.relativeTime, args=[amf.Object(level='error',code='NetStream.Play.StreamNotFound',description=str(E),details=None)])
+            response = CommandTemplate.status(cmd.id, stream.client.relativeTime, 'error', 'NetStream.Play.StreamNotFound', str(E))
             yield stream.send(response)
             
     def seekhandler(self, stream, cmd):
@@ -1320,11 +1913,11 @@ class FlashServer(object):
             if stream.playfile is None or stream.playfile.type != 'read': 
                 raise ValueError, 'Stream is not seekable'
             stream.playfile.seek(offset)
-            response = Command(name='onStatus', id=cmd.id, tm=stream.client.relativeTime, args=[amf.Object(level='status',code='NetStream.Seek.Notify', description=stream.name, details=None)])
+            response = CommandTemplate.status(cmd.id, stream.client.relativeTime, 'status', 'NetStream.Seek.Notify', stream.name)
             yield stream.send(response)
         except ValueError, E: # some error occurred. inform the app.
             if _debug: print 'error in seeking stream', str(E)
-            response = Command(name='onStatus', id=cmd.id, tm=stream.client.relativeTime, args=[amf.Object(level='error',code='NetStream.Seek.Failed',description=str(E),details=None)])
+            response = CommandTemplate.status(cmd.id, stream.client.relativeTime, 'error', 'NetStream.Seek.Failed', str(E))
             yield stream.send(response)
             
     def mediahandler(self, stream, message):
@@ -1333,15 +1926,51 @@ class FlashServer(object):
             inst = self.clients[stream.client.path][0]
             result = inst.onPublishData(stream.client, stream, message)
             if result:
+                frame = message.frame = Frame(message.data) # chunked once for all players with same chunking state
                 for s in (inst.players.get(stream.name, [])):
                     #if _debug: print 'D', stream.name, s.name
-                    m = message.dup()
+                    m = message.dup(); m.frame = frame
                     result = inst.onPlayData(s.client, s, m)
-                    if result:
+                    if result and s.admit(m):
                         yield s.send(m)
+                if stream.gop is not None: # after sending, so that a player added during send does not get it twice
+                    self.gopCacheSize += stream.gop.add(message)
+                    if self.gopCacheSize > self.gopCacheLimit: self.gopCacheSize -= stream.gop.drop()
                 if stream.recordfile is not None:
                     stream.recordfile.write(message)
 
+def _benchParse(count=20000, size=400, chunkSize=128):
+    '''Print chunks/sec of parseMessages and the field-by-field parser for count messages of size bytes each. Run as
+    $ python -c "import rtmp; rtmp._benchParse()"'''
+    class Sock(object): # serves recv from a fixed string, and uses an always readable fd for select
+        def __init__(self, data): self.data, self.pos, self.fd = data, 0, os.open(os.devnull, os.O_RDONLY)
+        def fileno(self): return self.fd
+        def setblocking(self, flag): pass
+        def close(self): os.close(self.fd)
+        def recv(self, size):
+            data = self.data[self.pos:self.pos+size]; self.pos += len(data); return data
+        def recv_into(self, buf, size=0):
+            data = self.recv(size or len(buf)); buf[:len(data)] = data; return len(data)
+    header, payload = Header(channel=3, time=0, size=size, type=Message.VIDEO, streamId=1), '\x27' * size
+    message = ''.join([header.toBytes(Header.FULL if i == 0 else Header.SEPARATOR) + payload[i:i+chunkSize] for i in xrange(0, size, chunkSize)])
+    chunks = count * ((size + chunkSize - 1) / chunkSize)
+    for zerocopy in (False, True):
+        for name in ('_parseMessagesByField', 'parseMessages'):
+            sock = Sock(message * count)
+            Protocol.ZEROCOPY = zerocopy; protocol = Protocol(sock); Protocol.ZEROCOPY = False
+            received = []
+            def messageReceived(msg): received.append(msg); yield
+            protocol.messageReceived = messageReceived
+            def parser():
+                try: yield getattr(protocol, name)()
+                except ConnectionClosed: pass
+            start = time.time()
+            multitask.add(parser()); multitask.run()
+            duration = time.time() - start
+            sock.close()
+            assert len(received) == count
+            print '%-22s %-18s %8d chunks/sec'%(name, type(protocol.stream).__name__, chunks / duration)
+
 # The main routine to start, run and stop the service
 if __name__ == '__main__':
     from optparse import OptionParser
@@ -1350,12 +1979,25 @@ if __name__ == '__main__':
     parser.add_option('-p', '--port',    dest='port',    default=1935, type="int", help='listening port number. Default 1935')
     parser.add_option('-r', '--root',    dest='root',    default='./',       help="document path prefix. Directory must end with /. Default './'")
     parser.add_option('-d', '--verbose', dest='verbose', default=False, action='store_true', help='enable debug trace')
+    parser.add_option('-z', '--zerocopy', dest='zerocopy', default=False, action='store_true', help='receive in a preallocated buffer without copying. Default is False')
+    parser.add_option('-q', '--max-queue-bytes', dest='maxQueueBytes', default=0, type="int", help='drop live media for a client with more bytes queued. Default 0 to disable')
+    parser.add_option('-Q', '--max-queue-delay', dest='maxQueueDelay', default=0, type="float", help='drop live media for a client with older data queued in seconds. Default 0 to disable')
+    parser.add_option('-w', '--record-writer', dest='recordWriter', default=0, type="int", help='max bytes of recorded media queued for a background writer thread. Default 0 to write inline')
+    parser.add_option('-f', '--fsync', dest='fsync', default=0, type="float", help='flush the recorded files to disk in this interval in seconds with the writer thread. Default 0 to disable')
+    parser.add_option('-m', '--vod-cache', dest='vodCache', default=0, type="int", help='max bytes of FLV files memory mapped for playback. Default 0 to disable')
+    parser.add_option('-g', '--gop-cache', dest='gopCache', default=0, type="int", help='max bytes of last GOP per live stream sent to new players. Default 0 to disable')
+    parser.add_option('-G', '--gop-cache-limit', dest='gopCacheLimit', default=64000000, type="int", help='max bytes of all GOP caches. Default 64000000')
     (options, args) = parser.parse_args()
     
     _debug = options.verbose
+    Protocol.ZEROCOPY = options.zerocopy
+    Protocol.MAX_QUEUE_BYTES, Protocol.MAX_QUEUE_DELAY = options.maxQueueBytes, options.maxQueueDelay
+    if options.vodCache: FLV.cache = VODCache(options.vodCache)
+    if options.recordWriter: FLV.writer = RecordWriter(options.recordWriter, options.fsync)
     try:
         agent = FlashServer()
         agent.root = options.root
+        agent.gopCache, agent.gopCacheLimit = options.gopCache, options.gopCacheLimit
         agent.start(options.host, options.port)
         if _debug: print time.asctime(), 'Flash Server Starts - %s:%d' % (options.host, options.port)
         multitask.run()
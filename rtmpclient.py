@@ -48,7 +48,11 @@ class Client(Protocol):
     class to do handshake() and send() RPC commands to the server. The send method itself receives the RPC response.'''
     def __init__(self, sock): # similar to the Client class of rtmp.py
         Protocol.__init__(self, sock)
-        self.streams, self.objectEncoding, self._nextCallId, self.queue, self.close_queue = {}, 0.0, 1, multitask.SmartQueue(), multitask.Queue()
+        self.streams, self.objectEncoding, self._nextCallId, self.queue, self.close_queue = {}, 0.0, 1, multitask.SmartQueue(key=Client._callId), multitask.Queue()
+    
+    @staticmethod
+    def _callId(cmd): # the key of the queued RPC responses, with None put when the connection is closed
+        return cmd.id if cmd is not None else None
             
     def handshake(self): # Implement the client side of the handshake. Must be invoked by caller after TCP connection completes.
         yield self.stream.write('\x03' + '\x00'*(Protocol.PING_SIZE)) # send first handshake
@@ -77,7 +81,7 @@ class Client(Protocol):
         if _debug: print 'Client.send cmd=', cmd, 'name=', cmd.name, 'args=', cmd.args, ' msg=', cmd.toMessage()
         yield self.writeMessage(cmd.toMessage())
         try: # wait for response if received within timeout.
-            res = yield self.queue.get(timeout=timeout, criteria=lambda x: x is None or x.id == callId)
+            res = yield self.queue.get(timeout=timeout, keys=(callId, None))
             result = res if res is not None and res.name == '_result' else None
             fault  = res if res is None or res.name == '_error' else None
             raise StopIteration, (result, fault)